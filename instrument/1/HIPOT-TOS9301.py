@@ -1,10 +1,25 @@
-import pyvisa
+from collections import namedtuple
+import enum
+import pyvisa as visa
+import visa_pool
+import scpi
+import timing
 import time
 import requests
-import logger as logging
-from plc import write_plc
+from logger import logger as logging, set_step
+from plc import write_plc, write_plc_many
 
 tos9301_resouce = '''TCPIP0::192.168.1.103::inst0::INSTR'''
+# 轮询测试状态: 起始间隔(秒)、最大间隔(秒)、间隔放大倍数
+poll_interval = 0.02
+poll_max_interval = 0.2
+poll_backoff = 1.5
+# 测试程序 -> 从启动到测试完成的用时统计
+test_times = {}
+
+# RES:REM? 返回的一条测试结果，数值字段已经转换好
+TestResult = namedtuple('TestResult', ['num', 'step', 'func', 'year', 'month', 'day', 'hour', 'min', 'sec',
+                                       'volt', 'curr', 'res', 'etim', 'judg'])
 # 数据读取时间延迟
 
 # 测试项目列表
@@ -24,41 +39,64 @@ TestItems = [
         "Unit": "mA"
     }
 ]
+class TestStatus(enum.IntFlag):
+    """
+    STAT:OPER:TEST:COND? 的状态位，用 TestStatus.IDLE in status 判断
+    """
+    PASS = 1 << 0
+    L_FAIL = 1 << 1
+    U_FAIL = 1 << 2
+    RISE = 1 << 4
+    TEST = 1 << 5
+    FALL = 1 << 6
+    DISCHARGE = 1 << 7
+    READY = 1 << 8
+    IDLE = 1 << 9
+    STOP = 1 << 10
+    PROTECT = 1 << 11
+    DVDT_FAIL = 1 << 12
+    CONTACT_CHECK = 1 << 14
+
+
 def get_test_status(device):
     """
-    获取测试状态
+    获取测试状态，状态变化时记录日志
     :param device: 设备对象
-    :return: 测试状态字典
+    :return: TestStatus
     """
-    # 发送查询命令
+    # 发送查询命令，状态字是16位，按有符号数返回时取低16位
     response = device.query('STAT:OPER:TEST:COND?\n').strip()
-    print(response)
-    response = response.lstrip('+-')
-    # 确保响应是数字
-    if response.isdigit():
-        # 将字符串转换为整数
-        response_int = int(response)
-        # 拆解不同的位到一个字典中
-        test_status = {
-            'PASS': response_int & 1,
-            'L-FAIL': (response_int >> 1) & 1,
-            'U-FAIL': (response_int >> 2) & 1,
-            'RESERVED-3': (response_int >> 3) & 1,
-            'RISE': (response_int >> 4) & 1,
-            'TEST': (response_int >> 5) & 1,
-            'FAIL': (response_int >> 6) & 1,
-            'DISCHARGE': (response_int >> 7) & 1,
-            'READY': (response_int >> 8) & 1,
-            'IDLE': (response_int >>9) & 1,
-            'STOP': (response_int >> 10) & 1,
-            'PROTECT': (response_int >> 11) & 1,
-            'dV/dt FAIL': (response_int >> 12) & 1,
-            'RESERVED-13': (response_int >> 13) & 1,
-            'CONTACT-CHECK': (response_int >> 14) & 1,
-            'RESERVED-15': (response_int >> 15) & 1,
-        }
-        return test_status
-    raise ValueError('Invalid response: {}'.format(response))
+    try:
+        status = TestStatus(int(response) & 0xFFFF)
+    except ValueError:
+        raise ValueError('Invalid response: {}'.format(response))
+    state = visa_pool.session_state(device)
+    if state.get('test_status') != status:
+        logging.debug(f"测试状态: {status!r}")
+        state['test_status'] = status
+    return status
+
+
+def parse_test_result(response):
+    """
+    解析一条测试结果
+    :param response: NUM,STEP,FUNC,YEAR,MONTH,DAY,HOUR,MIN,SEC,VOLT,CURR,RES,ETIM,JUDG
+    :return: TestResult
+    """
+    fields = response.split(',')
+    return TestResult(int(fields[0]), int(fields[1]), fields[2].strip('"'),
+                      *map(int, fields[3:8]), float(fields[8]),
+                      *map(float, fields[9:13]), fields[13].strip('"'))
+
+
+def _remove_results(device):
+    # 取出结果缓冲区里现有的结果，缓冲区为空时返回 +0
+    while True:
+        response = device.query('RES:REM?\n').strip()
+        if response == '+0':
+            return
+        yield parse_test_result(response)
+
 
 def get_test_result(device):
     """
@@ -66,49 +104,118 @@ def get_test_result(device):
     :param device: 设备对象
     :return: 测试结果列表
     """
-    results=[]
-    while True:
-        response = device.query('RES:REM?\n').strip()
-        if response=='+0':
-            break
-        print(response)
-        # 解析并存储测试结果
-        result = {
-            'NUM': response.split(',')[0],
-            'STEP': response.split(',')[1],
-            'FUNC': response.split(',')[2],
-            'YEAR': response.split(',')[3],
-            'MONTH': response.split(',')[4],
-            'DAY': response.split(',')[5],
-            'HOUR': response.split(',')[6],
-            'MIN': response.split(',')[7],
-            'SEC': response.split(',')[8],
-            'VOLT': response.split(',')[9],
-            'CURR': response.split(',')[10],
-            'RES': response.split(',')[11],
-            'ETIM': response.split(',')[12],
-            'JUDG': response.split(',')[13],
-        }
-        results.append(result)        
-    return results
-    
-def wait_for_test_complete(device, timeout=20):
+    return list(_remove_results(device))
+
+
+def drain_results(device):
     """
-    等待测试完成
+    丢弃上次测试残留在结果缓冲区里的结果
+    仪器没有清空结果缓冲区的命令，按 RES:COUN? 的条数取出，不做解析
+    :param device: 设备对象
+    """
+    count = int(device.query('RES:COUN?').strip())
+    for _ in range(count):
+        device.query('RES:REM?')
+
+
+def iter_test_results(device, timeout=20):
+    """
+    测试进行中轮询状态，每完成一步就产生一条结果，测试结束或超时后停止
     :param device: 设备对象
     :param timeout: 超时时间（秒）
-    :return: 测试是否完成
+    :return: 生成器，产生 TestResult，结束时返回测试是否完成
     """
-    start_time = time.time()
+    count = 0
+    done = _test_done(device, lambda: count)
+    deadline = time.monotonic() + timeout
+    interval = poll_interval
     while True:
-        status = get_test_status(device)
-        if status["IDLE"]==1:
+        # 先判断状态再取结果，测试结束前完成的步骤都能取到
+        with timing.span("status"):
+            finished = done()
+        with timing.span("fetch"):
+            results = list(_remove_results(device))
+        count += len(results)
+        yield from results
+        if finished:
             return True
-        elif time.time() - start_time > timeout:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.warning(f"测试超过{timeout}秒没有完成")
             return False
-        time.sleep(1)
-        print("Test is still running...")
-            
+        timing.sleep(min(interval, remaining))
+        interval = min(interval * poll_backoff, poll_max_interval)
+
+
+def _test_done(device, received=None):
+    """
+    生成判断测试结束的函数: 回到 IDLE，并且看到过测试离开 IDLE 或者已经有本次测试的结果
+    INIT:TEST 后还没离开 IDLE 时继续等待，直到调用方超时
+    :param device: 设备对象
+    :param received: 返回已经取走的结果条数的函数
+    """
+    running = False
+
+    def check():
+        nonlocal running
+        if TestStatus.IDLE not in get_test_status(device):
+            running = True
+            return False
+        if running or (received is not None and received() > 0):
+            return True
+        # 测试太短没有轮询到运行状态时，结果缓冲区里有结果说明已经测完
+        return int(device.query('RES:COUN?').strip()) > 0
+    return check
+
+
+def wait_for_test_complete(device, timeout=20):
+    """
+    等待测试完成，轮询间隔从 poll_interval 逐渐加长到 poll_max_interval
+    :param device: 设备对象
+    :param timeout: 超时时间（秒）
+    :return: 测试是否完成
+    """
+    return bool(scpi.poll(_test_done(device), timeout, poll_interval, poll_max_interval, poll_backoff))
+
+
+async def wait_for_test_complete_async(device, timeout=20):
+    """
+    wait_for_test_complete 的异步版本，等待期间不阻塞事件循环
+    查询在 asyncio.to_thread 的线程里执行，不经过 main.py 里该仪器的串行通道，
+    只能在没有其他请求使用这台仪器时调用(例如单独调试)
+    :param device: 设备对象
+    :param timeout: 超时时间（秒）
+    :return: 测试是否完成
+    """
+    return bool(await scpi.poll_async(_test_done(device), timeout, poll_interval, poll_max_interval, poll_backoff))
+
+
+def record_test_time(program, elapsed, complete):
+    """
+    记录测试程序的用时
+    :param program: 测试程序名
+    :param elapsed: 从启动到测试完成的时间（秒）
+    :param complete: 是否在超时前完成
+    """
+    stats = test_times.setdefault(program, {"count": 0, "timeouts": 0, "total": 0.0,
+                                            "min": None, "max": 0.0, "last": 0.0})
+    if not complete:
+        stats["timeouts"] += 1
+        return
+    stats["count"] += 1
+    stats["total"] += elapsed
+    stats["last"] = elapsed
+    stats["max"] = max(stats["max"], elapsed)
+    stats["min"] = elapsed if stats["min"] is None else min(stats["min"], elapsed)
+
+
+def get_test_times():
+    """
+    查询各测试程序的用时统计
+    :return: {程序名: {count, timeouts, min, max, last, avg}}
+    """
+    return {program: dict(stats, avg=stats["total"] / stats["count"] if stats["count"] else None)
+            for program, stats in test_times.items()}
 
 
 def connect_device(resource):
@@ -117,17 +224,8 @@ def connect_device(resource):
     :param resource: 设备资源地址
     :return: 设备对象
     """
-    # 创建一个资源管理器
-    rm = pyvisa.ResourceManager()
-    # 连接到指定的设备
-    device = rm.open_resource(resource)
-    # 判断连接是否成功
-    if device.query('*IDN?') == '':
-        logging.debug("连接失败")
-    else:
-        logging.debug("连接成功")
-    # 返回设备对象
-    return device
+    # 从会话池取出设备，会话在测试周期之间保持打开
+    return visa_pool.get_device(resource)
 
 
 def close_device(device):
@@ -135,8 +233,8 @@ def close_device(device):
     关闭设备连接
     :param device: 设备对象
     """
-    # 关闭与仪器的连接
-    device.close()
+    # 归还设备，不关闭连接
+    visa_pool.release_device(device)
 
 
 def check_protect(device):
@@ -153,6 +251,37 @@ def check_protect(device):
     return protect_condition == "0"
 
 
+def measure_iter(resource,param={"program":'2983'}):
+    """
+    对设备进行测量，测试进行中逐条产生结果
+    :param resource: 设备资源地址
+    :param param: 测量参数字典，包括程序名
+    :return: 生成器，产生 TestResult
+    """
+    device = connect_device(resource)
+    try:
+        with timing.span("configure"):
+            device.write("*RST;*CLS;")
+            # 启动前清掉残留结果，启动后再清会把本次测试已经完成的步骤丢掉
+            drain_results(device)
+            device.write(f'PROG "/BASIC/{param["program"]}"')
+        with timing.span("trigger"):
+            device.write('INIT:TEST')
+        start = time.perf_counter()
+        complete = yield from iter_test_results(device)
+        record_test_time(param["program"], time.perf_counter() - start, complete)
+    except visa.VisaIOError as e:
+        logging.error(f"耐压仪 {resource} 通信失败: {e}")
+        # 丢弃出错的会话，下次测试重新连接。归还后空闲不到 check_interval 不会做健康检查，会一直用失效的会话
+        visa_pool.invalidate(resource)
+        device = None
+        raise
+    finally:
+        # 调用方中途停止读取时也归还设备
+        if device is not None:
+            close_device(device)
+
+
 def measure(resource,param={"program":'2983'}):
     """
     对设备进行测量
@@ -160,39 +289,42 @@ def measure(resource,param={"program":'2983'}):
     :param param: 测量参数字典，包括程序名
     :return: 测量结果
     """
-    device = connect_device(resource)
-    device.write("*RST;*CLS;")
-    device.write(f'PROG "/BASIC/{param["program"]}"')
-    device.write('INIT:TEST')
-    get_test_result(device)
-    time.sleep(1)
-    wait_for_test_complete(device)
-    result=get_test_result(device)
-    return result
+    return list(measure_iter(resource, param))
 
+@timing.traced
 def main():
     """
     主程序，控制测试流程
     """
-    write_plc("D5050", 0)     # 清除请求信号
-    write_plc("D6050", 0)     # 清除完成信号
-    results=measure(resource=tos9301_resouce)
+    write_plc_many({"D5050": 0,     # 清除请求信号
+                    "D6050": 0})    # 清除完成信号
     final_result="PASS"
+    # 清掉上一个产品的测试值，没有收到结果的项目按不合格处理
+    for item in TestItems:
+        item.pop("Value", None)
+        item["Result"]="FAIL"
+    received=0
+    # 每完成一步就把测试结果和测试值顺序写入testitems
+    for i, result in enumerate(measure_iter(resource=tos9301_resouce)):
+        received+=1
+        set_step(TestItems[i]["Name"])
+        logging.debug(result)
+        TestItems[i]["Result"]=result.judg
+        if result.func=="DCW":
+            TestItems[i]["Value"]=result.curr*1000
+        if result.func=="IR":
+           TestItems[i]["Value"]=result.res/1000000
+        if result.judg != "PASS":
+            final_result="FAIL"
+    # 收到的结果比测试项少(测试没有启动、超时等)也按不合格处理
+    if received < len(TestItems):
+        final_result="FAIL"
     # 如果所有结果都是PASS,则写入完成信号
-    if all(result["JUDG"] == "PASS" for result in results):
-        final_result="PASS"
+    if final_result=="PASS":
         write_plc("D6051", 1)
     else:
-        final_result="FAIL"
         write_plc("D6051", 0)
     write_plc("D6050", 1)      # 置位完成信号
-    # 把测试结果和测试值写入testitems 顺序写入
-    for i, result in enumerate(results):
-        TestItems[i]["Result"]=result["JUDG"]
-        if result["FUNC"]=="DCW":
-            TestItems[i]["Value"]=float(result["CURR"])*1000
-        if result["FUNC"]=="IR":
-           TestItems[i]["Value"]=float(result["RES"])/1000000
     return {
         "Name":"耐压测试",
         "Result":final_result,
@@ -1,7 +1,9 @@
-import pyvisa as visa
-from plc import write_plc
-import time
-from logger import logger as logging
+import visa_pool
+import scpi
+import settling
+import timing
+from plc import write_plc, write_plc_many, write_plc_async, flush_plc
+from logger import logger as logging, set_step
 TestItems = [
     {
         "Name": "DC+ - DC+'",
@@ -42,25 +44,24 @@ TestItems = [
 # e4890_resouce= '''USB0::0x2A8D::0x2F01::MY46624897::INSTR'''
 e4890_resouce = '''USB0::0x2A8D::0x2F01::MY46624897::INSTR'''
 relay_delay = 0.2
+# 读数稳定判断: 相对容差、最长等待时间(秒)、连续读数个数
+settle_tolerance = 0.005
+settle_max_wait = relay_delay + 1.0
+settle_count = 2
+# 写入步骤后继电器开始动作前的读数不可信，至少等待的时间(秒)
+relay_min_delay = 0.05
+# 上一项的读数。读数稳定在这个值上时分不清是夹具还没动作，这种情况至少等到 relay_delay
+last_value = None
 
 
 def connect_device(resource):
-    # 创建一个资源管理器
-    rm = visa.ResourceManager()
-    # 连接到指定的设备
-    device = rm.open_resource(resource)
-    # 判断连接是否成功
-    if device.query('*IDN?') == '':
-        logging.debug("连接失败")
-    else:
-        logging.debug("连接成功")
-    # 返回设备对象
-    return device
+    # 从会话池取出设备，会话在测试周期之间保持打开
+    return visa_pool.get_device(resource)
 
 
 def close_device(device):
-    # 关闭与仪器的连接
-    device.close()
+    # 归还设备，不关闭连接
+    visa_pool.release_device(device)
 
 
 
@@ -83,85 +84,109 @@ def calibration(mode):
 
 
 
+def apply_settings(device, settings):
+    # 只下发和仪器当前设置不同的项，同一设置项的命令一起下发
+    # settings: [(设置项, [命令, ...]), ...]
+    applied = visa_pool.session_state(device).setdefault('settings', {})
+    changed = [(key, commands) for key, commands in settings if applied.get(key) != commands]
+    # 有变化的命令拼成一次写入
+    with timing.span("configure"), scpi.CommandBatch(device) as batch:
+        for key, commands in changed:
+            for command in commands:
+                batch.write(command)
+    applied.update(changed)
+
+
 def config_ls(device,freq,voltage):
-    # 设置测量功能为电感和串联电阻
-    device.write(':FUNC:IMP:TYPE LSRS')
-    # 打开自动测量范围
-    device.write(':FUNC:IMP:RANG:AUTO ON')
-    # 设置测量范围为100欧姆
-    device.write(':FUNCtion:IMPedance:RANGe 100;')
-    # 设置频率10k
-    device.write(f':FREQ {freq};')
-    # 设置电压
-    device.write(f':VOLT {voltage}')
-    # 设置电流10mA
-    device.write(':CURR 10;')
-    # 设置速度和分辨率
-    device.write(':APERture MED,1')
+    apply_settings(device, [
+        # 设置测量功能为电感和串联电阻
+        ('type', [':FUNC:IMP:TYPE LSRS']),
+        # 打开自动测量范围，设置测量范围为100欧姆
+        ('range', [':FUNC:IMP:RANG:AUTO ON', ':FUNCtion:IMPedance:RANGe 100;']),
+        # 设置频率10k
+        ('freq', [f':FREQ {freq};']),
+        # 设置电压，设置电流10mA (:VOLT 和 :CURR 会互相切换信号模式，作为一项缓存)
+        ('level', [f':VOLT {voltage}', ':CURR 10;']),
+        # 设置速度和分辨率
+        ('aperture', [':APERture MED,1']),
+    ])
 
 
 def config_cap(device,freq,voltage):
-    # 设置测量功能为电容和并联电阻
-    device.write(':FUNC:IMP:TYPE CPD')
-    # 打开自动测量范围
-    device.write(':FUNC:IMP:RANG:AUTO ON')
-    # 设置测量范围为100欧姆
-    device.write(':FUNCtion:IMPedance:RANGe 100;')
-    # 设置频率1khz
-    device.write(f':FREQ {freq};')
-    # 设置电压
-    device.write(f':VOLT {voltage};')
-    # 设置速度和分辨率
-    device.write(':APERture MED,1')
+    apply_settings(device, [
+        # 设置测量功能为电容和并联电阻
+        ('type', [':FUNC:IMP:TYPE CPD']),
+        # 打开自动测量范围，设置测量范围为100欧姆
+        ('range', [':FUNC:IMP:RANG:AUTO ON', ':FUNCtion:IMPedance:RANGe 100;']),
+        # 设置频率1khz
+        ('freq', [f':FREQ {freq};']),
+        # 设置电压
+        ('level', [f':VOLT {voltage};']),
+        # 设置速度和分辨率
+        ('aperture', [':APERture MED,1']),
+    ])
 
 
 def measure(device):
-    # 开始测量
-    device.write(':INIT')
-    # 等待测量完成
-    device.query('*OPC?')
-    # 读取测量结果
-    result = device.query(':FETC?')
+    with timing.span("trigger"):
+        # 开始测量
+        device.write(':INIT')
+        # 等待测量完成
+        device.query('*OPC?')
+    with timing.span("fetch"):
+        # 读取测量结果
+        result = device.query(':FETC?')
     return result
 
 
+def read_value(device):
+    # -1.22084E+02,+9.47753E+05,+0 取主参数
+    return float(measure(device).split(',')[0])
+
+
+def measure_settled(device, item):
+    global last_value
+    set_step(item['Name'])
+    # 确认切换步骤已经写到PLC，再连续测量直到读数稳定，稳定时间按 模块:测试项 记录
+    flush_plc()
+    settled = settling.settle(lambda: read_value(device), relay_delay, key=f"{__name__}:{item['Name']}",
+                              tolerance=settle_tolerance, max_wait=settle_max_wait,
+                              count=settle_count, min_wait=relay_min_delay,
+                              previous=last_value, stale_wait=relay_delay)
+    last_value = settled.value
+    return settled
+
+
+@timing.traced
 def main():
     plc_step_addr = "D6080"
     # 清除 D5080/D6081 D6082
-    write_plc('D5080', 0)
-    write_plc('D6081', 0)
-    write_plc('D6082', 0)
+    write_plc_many({'D5080': 0, 'D6081': 0, 'D6082': 0})
     # 连接设备
     device = connect_device(e4890_resouce)
-    write_plc(plc_step_addr, 0)
+    write_plc_async(plc_step_addr, 0)
     # 测量电感 DC+ - DC+'
     config_ls(device,100000,0.1)
-    result = measure(device)
-    print(result)
-    logging.debug(result + '\n')
-    # -1.22084E+02,+9.47753E+05,+0 提取电感值
-    result = result.split(',')
-    result = float(result[0]) * 1000000
+    settled = measure_settled(device, TestItems[0])
+    logging.debug(settled)
+    result = settled.value * 1000000
     TestItems[0]['Value'] = result
+    TestItems[0]['SettleTime'] = round(settled.settled_after, 3)
 
     # 根据上下限判断是否合格
     if TestItems[0]['Lower'] < result < TestItems[0]['Upper']:
         TestItems[0]['Result'] = 'PASS'
     else:
         TestItems[0]['Result'] = 'FAIL'
-    write_plc(plc_step_addr, 1)
-    time.sleep(relay_delay)
+    write_plc_async(plc_step_addr, 1)
 
     # 测量电感 DC- - DC-'
     config_ls(device,100000,0.1)
-    result = measure(device)
-    logging.debug(result)
-    print(result + '\n')
-
-    # -1.22084E+02,+9.47753E+05,+0 提取电感值
-    result = result.split(',')
-    result = float(result[0]) * 1000000
+    settled = measure_settled(device, TestItems[1])
+    logging.debug(settled)
+    result = settled.value * 1000000
     TestItems[1]['Value'] = result
+    TestItems[1]['SettleTime'] = round(settled.settled_after, 3)
 
     # 根据上下限判断是否合格
     if TestItems[1]['Lower'] < result < TestItems[1]['Upper']:
@@ -169,21 +194,16 @@ def main():
     else:
         TestItems[1]['Result'] = 'FAIL'
 
-    write_plc(plc_step_addr, 2)
-    time.sleep(relay_delay)
+    write_plc_async(plc_step_addr, 2)
 
     # 测量电容 DC+ - DC-
     config_cap(device,1000,1)
-    result = measure(device)
-    logging.debug(result)
-    print(result + '\n')
-    write_plc(plc_step_addr, 3)
-    time.sleep(relay_delay)
-
-    # -1.22084E+02,+9.47753E+05,+0 提取电感值
-    result = result.split(',')
-    result = float(result[0]) * 1000000000
+    settled = measure_settled(device, TestItems[2])
+    logging.debug(settled)
+    write_plc_async(plc_step_addr, 3)
+    result = settled.value * 1000000000
     TestItems[2]['Value'] = result
+    TestItems[2]['SettleTime'] = round(settled.settled_after, 3)
 
     # 根据上下限判断是否合格
     if TestItems[2]['Lower'] < result < TestItems[2]['Upper']:
@@ -193,15 +213,12 @@ def main():
 
     # 测量电容 DC+ - gnd
     config_cap(device,1000,1)
-    result = measure(device)
-    logging.debug(result)
-    print(result + '\n')
-    write_plc(plc_step_addr, 4)
-    time.sleep(relay_delay)
-    # -1.22084E+02,+9.47753E+05,+0 提取电感值
-    result = result.split(',')
-    result = float(result[0]) * 1000000000
+    settled = measure_settled(device, TestItems[3])
+    logging.debug(settled)
+    write_plc_async(plc_step_addr, 4)
+    result = settled.value * 1000000000
     TestItems[3]['Value'] = result
+    TestItems[3]['SettleTime'] = round(settled.settled_after, 3)
 
     # 根据上下限判断是否合格
     if TestItems[3]['Lower'] < result < TestItems[3]['Upper']:
@@ -211,16 +228,12 @@ def main():
 
     # 测量电容 DC- - gnd
     config_cap(device,1000,1)
-    result = measure(device)
-    logging.debug(result + '\n')
-    write_plc(plc_step_addr, 5)
-    print(result)
-    logging.debug(result)
-
-    # -1.22084E+02,+9.47753E+05,+0 提取电感值
-    result = result.split(',')
-    result = float(result[0]) * 1000000000
+    settled = measure_settled(device, TestItems[4])
+    logging.debug(settled)
+    write_plc_async(plc_step_addr, 5)
+    result = settled.value * 1000000000
     TestItems[4]['Value'] = result
+    TestItems[4]['SettleTime'] = round(settled.settled_after, 3)
 
     # 根据上下限判断是否合格
     if TestItems[4]['Lower'] < result < TestItems[4]['Upper']:
@@ -232,14 +245,17 @@ def main():
     # 输出结果
     # 如果testitems[0] 和 testitems[1] 都是PASS,则给PLC写1，否则写2
     if TestItems[0]['Result'] == 'PASS' and TestItems[1]['Result'] == 'PASS':
-        write_plc("D6081", 1)
+        l_result = 1
     else:
-        write_plc("D6081", 2)
+        l_result = 2
     # 如果testitems[2] 和 testitems[3] 和 testitems[4] 都是PASS,则给PLC写1，否则写2
     if TestItems[2]['Result'] == 'PASS' and TestItems[3]['Result'] == 'PASS' and TestItems[4]['Result'] == 'PASS':
-        write_plc("D6082", 1)
+        c_result = 1
     else:
-        write_plc("D6082", 2)
+        c_result = 2
+    # 进度写完后再写结果
+    flush_plc()
+    write_plc_many({"D6081": l_result, "D6082": c_result})
 
     write_plc(plc_step_addr, 10)
     final_result='PASS'
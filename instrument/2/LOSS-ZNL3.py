@@ -1,204 +1,355 @@
-import pyvisa as visa
+import visa_pool
+import scpi
+import settling
+import timing
+import limits
+import matplotlib
+# 测试在仪器通道的工作线程里执行，不能用需要主线程的 GUI 后端
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import time
+import hashlib
+import json
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from plc import write_plc
-from logger import logger as logging
-from switch import switch_channel
+from plc import write_plc, write_plc_many
+from logger import logger as logging, set_step
+from switch import switch_channel, settle_time, routes
 
 znl_resouce = '''TCPIP0::192.168.1.16::inst0::INSTR'''
-frequency = [10, 20, 60, 100, 150, 500, 1000, 1500, 10000, 16000, 30000, 40000, 60000,100000]
+# ZNL 输入缓冲区足够大，一次写入的最大长度
+scpi_max_length = 2048
+# 扫描时间(秒)，None 为仪器自动选择最短扫描时间
+sweep_time = None
+# 等待扫描完成的超时时间(秒)
+sweep_timeout = 10
+# 轮询扫描是否完成: 起始间隔(秒)、最大间隔(秒)、间隔放大倍数
+poll_interval = 0.005
+poll_max_interval = 0.2
+poll_backoff = 1.5
+# profile 模式判断扫描结果稳定: 相对容差、最长等待时间(秒)
+profile_tolerance = 0.01
+profile_max_wait = 5
+# 切换开关的后台线程
+_router = ThreadPoolExecutor(max_workers=1, thread_name_prefix="znl-switch")
+# 每个频率点定义一个段(单点)的参数
+segment_format = '{freq}kHz,{freq}kHz,1,0dBm,AUTO,2,300 Hz'
 
-l1_lower = [5, 7, 12, 20, 29, 48, 42, 34, 32, 25, 34, 24, 24, 15]
-l1_upper = [12, 15, 18, 29, 40, 78, 100, 58, 50, 46, 78, 80, 90, 90]
-
-l2_lower = [5, 7, 12, 20, 29, 48, 42, 34, 32, 25, 34, 24, 24, 15]
-l2_upper =[12, 15, 18, 29, 40, 78, 100, 58, 50, 46, 78, 80, 90, 90]
+# 本站配置: 测量的通路(routes.json 里的通路名)、频率点(kHz)和各通路的上下限
+# 增加通路只需要改 routes.json 和本文件同名的 .json
+station_file = os.path.splitext(os.path.abspath(__file__))[0] + ".json"
+with open(station_file, encoding='utf-8') as _f:
+    _station = json.load(_f)
+channels = tuple(str(channel) for channel in _station["channels"])
+frequency = _station["frequency"]
+# 上下限按 (频率Hz, 限值) 折点定义，判定时插值到仪器实际返回的扫描点，按通路名查找
+limit_lines = {
+    name: (limits.LimitLine(np.array(frequency) * 1000, line["lower"]),
+           limits.LimitLine(np.array(frequency) * 1000, line["upper"]))
+    for name, line in _station["limits"].items()
+}
+for _channel in channels:
+    if _channel not in routes:
+        raise ValueError(f"{station_file}: routes.json 里没有定义通路 {_channel}")
+    if _channel not in limit_lines:
+        raise ValueError(f"{station_file}: 通路 {_channel} 没有定义上下限")
 
 
 def connect_device(resource):
-    # 创建一个资源管理器
-    rm = visa.ResourceManager()
-    # 连接到指定的设备
-    device = rm.open_resource(znl_resouce)
-    # 判断连接是否成功
-    if device.query('*IDN?') == '':
-        logging.debug("连接失败")
-    else:
-        logging.debug("连接成功")
-    # 返回设备对象
-    return device
+    # 从会话池取出设备，会话在测试周期之间保持打开
+    return visa_pool.get_device(znl_resouce)
 
 
 def close_device(device):
-    # 关闭与仪器的连接
-    device.close()
+    # 归还设备，不关闭连接
+    visa_pool.release_device(device)
+
+
+def config_fingerprint():
+    # 段表指纹: 频率点和段参数，其他设置写在代码里，只会随程序重启变化
+    return hashlib.md5(repr((frequency, segment_format, sweep_time)).encode()).hexdigest()
+
 
+def segments_loaded(device):
+    # 仪器复位后段表会被清掉，用段数量判断
+    return int(float(device.query('SENS1:SEGM:COUN?'))) == len(frequency)
 
-def config(device):
+
+def config(device, force=False):
+    """
+    配置仪器，段表没有变化时跳过
+    :param device: 设备对象
+    :param force: 强制重新配置
+    :return: 是否下发了配置
+    """
+    state = visa_pool.session_state(device)
+    fingerprint = config_fingerprint()
+    # 重新连接后 state 为空，会完整配置一次
+    if not force and state.get('config') == fingerprint and segments_loaded(device):
+        logging.debug("段表没有变化，跳过配置")
+        return False
+    # 设置命令拼接后批量下发
+    batch = scpi.CommandBatch(device, scpi_max_length)
     # 选择设备的通道1
-    device.write('INST:SEL CHANNEL1;')
+    batch.write('INST:SEL CHANNEL1;')
     # 设置设备的功能为S21功率传输
-    device.write('SENS1:FUNC "XFR:POW:S21";')
+    batch.write('SENS1:FUNC "XFR:POW:S21";')
     # 打开设备的显示更新
-    device.write('SYST:DISP:UPD ON;')
+    batch.write('SYST:DISP:UPD ON;')
     # 设置设备的计算格式为幅度
-    device.write('CALC1:FORM MAGN;')
+    batch.write('CALC1:FORM MAGN;')
     # 设置设备的源功率级别为0dbm
-    device.write('SOUR1:POW:LEV 0dbm;')
+    batch.write('SOUR1:POW:LEV 0dbm;')
     # 设置设备的扫描空间为对数
-    device.write('SENS1:SWE:SPAC LOG;')
-    device.write('SENS1:SWE:TIME:AUTO ON;')
-    device.write('SENS1:SWE:POIN 400;')
-    device.write('SENS1:BAND:AUTO ON;')
-    device.write('SENS1:BAND 1kHz;')
-    device.write('DISP:WIND1:TRAC1:Y:SCAL:TOP 0dB;')
-    device.write('DISP:WIND1:TRAC1:Y:SCAL:BOTT -120dB;')
-    device.write('SENS1:DET:FUNC NORM;')
+    batch.write('SENS1:SWE:SPAC LOG;')
+    batch.write('SENS1:SWE:TIME:AUTO ON;')
+    batch.write('SENS1:SWE:POIN 400;')
+    batch.write('SENS1:BAND:AUTO ON;')
+    batch.write('SENS1:BAND 1kHz;')
+    batch.write('DISP:WIND1:TRAC1:Y:SCAL:TOP 0dB;')
+    batch.write('DISP:WIND1:TRAC1:Y:SCAL:BOTT -120dB;')
+    batch.write('SENS1:DET:FUNC NORM;')
     # 设置设备的平均模式为点
-    device.write('SENS1:AVER:MODE POIN;')
+    batch.write('SENS1:AVER:MODE POIN;')
     # 设置设备的平均计数为2
-    device.write('SENS1:AVER:COUN 2;')
+    batch.write('SENS1:AVER:COUN 2;')
     # 打开设备的平均功能
-    device.write('SENS1:AVER ON;')
+    batch.write('SENS1:AVER ON;')
     # 设置设备的源功率级别为0dbm
-    device.write('SOUR1:POW:LEV 0dbm;')
+    batch.write('SOUR1:POW:LEV 0dbm;')
     # 设置设备的带宽为1kHz
-    device.write('SENS1:BAND 300Hz;')
+    batch.write('SENS1:BAND 300Hz;')
     # 设置设备的频率起始值为10kHz
-    device.write('SENS1:FREQ:START 10 kHz;')
+    batch.write('SENS1:FREQ:START 10 kHz;')
     # 设置设备的频率结束值为100000kHz
-    device.write('SENS1:FREQ:STOP 100000 kHz;')
+    batch.write('SENS1:FREQ:STOP 100000 kHz;')
     # 清除设备的所有段
-    device.write('SENS1:SEGM:CLE;')
+    batch.write('SENS1:SEGM:CLE;')
 
     # 为每个频率点定义一个频率段
     for i, freq in enumerate(frequency):
-        device.write(f'SENS1:SEGM:DEF{i + 1} {freq}kHz,{freq}kHz,1,0dBm,AUTO,2,300 Hz;')
+        batch.write(f'SENS1:SEGM:DEF{i + 1} {segment_format.format(freq=freq)};')
 
     # 设置设备的频率模式为段
-    device.write('SENS1:FREQ:MODE SEGM;')
-
+    batch.write('SENS1:FREQ:MODE SEGM;')
 
-def get_data(device):
+    # 扫描设置，两个通道共用，随配置一次下发
     # 打开设备的显示更新
-    device.write('SYST:DISP:UPD ON')
+    batch.write('SYST:DISP:UPD ON')
     # 关闭设备的错误显示
-    # 关闭设备的自动扫描时间
-    device.write('SENS1:SWE:TIME:AUTO OFF')
-    # 设置设备的扫描时间为1秒
-    device.write('SENS1:SWE:TIME 1')
+    if sweep_time is None:
+        # 自动扫描时间，扫描完成后由 *OPC 通知，不再固定等待
+        batch.write('SENS1:SWE:TIME:AUTO ON')
+    else:
+        # 关闭设备的自动扫描时间
+        batch.write('SENS1:SWE:TIME:AUTO OFF')
+        # 设置设备的扫描时间
+        batch.write(f'SENS1:SWE:TIME {sweep_time}')
     # 设置设备的计算格式为对数幅度
-    device.write('CALC1:FORM MLOG')
+    batch.write('CALC1:FORM MLOG')
     # 设置设备的图形显示范围为10dB
-    device.write('CALC1:GDAP:SCO 10')
+    batch.write('CALC1:GDAP:SCO 10')
     # 设置设备的扫描点数为100
-    device.write('SWE:POIN 100')
+    batch.write('SWE:POIN 100')
     # 设置设备的损失补偿值为-12dB
-    device.write('CORRection:LOSS:OFFSet 0')
+    batch.write('CORRection:LOSS:OFFSet 0')
     # 设置设备的频率起始值为10000Hz
     # 设置设备的频率起始值为10000Hz
-    device.write('FREQuency:STARt 10000')
+    batch.write('FREQuency:STARt 10000')
     # 设置设备的频率结束值为60000000Hz
-    device.write('FREQ:STOP 10000000')
-    # 打开设备的连续初始化模式
-    device.write('INIT:CONT:ALL ON')
+    batch.write('FREQ:STOP 10000000')
+    # 关闭连续扫描，每次由 trigger 启动一次扫描
+    batch.write('INIT:CONT:ALL OFF')
     # 设置设备的扫描次数为1
-    device.write('SWE:COUN:ALL 1')
+    batch.write('SWE:COUN:ALL 1')
     # 设置设备的初始化范围为全部
-    device.write('INIT1:SCOP ALL')
-    # 触发设备开始初始化，并等待初始化完成
-    device.write('INIT1;*OPC')
+    batch.write('INIT1:SCOP ALL')
+    batch.flush()
+    logging.debug(f"配置下发{batch.commands}条命令，写入{batch.writes}次，节省{batch.saved}次往返")
+    state['config'] = fingerprint
+    # 重新配置后扫描点要重新读取；仪器复位后 FORM:BORD 回到 NORMal，字节序也要重新设置
+    state.pop('stimulus', None)
+    state.pop('big_endian', None)
+    return True
+
+
+def byte_order(device):
+    # 二进制数据的字节序每次配置后只设置一次，固定为小端
+    state = visa_pool.session_state(device)
+    if 'big_endian' not in state:
+        device.write('FORM:BORD SWAP')
+        state['big_endian'] = False
+    return state['big_endian']
+
+
+# 通道 -> 预先分配的测量数据缓冲区
+_buffers = {}
+
+
+def data_buffer(channel, size):
+    buffer = _buffers.get(channel)
+    if buffer is None or buffer.shape[0] != size:
+        buffer = _buffers[channel] = np.empty(size, dtype='f4')
+    return buffer
+
+
+def trigger(device):
+    # 触发设备开始初始化，轮询 *OPC 等待扫描完成
+    start = time.perf_counter()
+    device.write('*CLS;INIT1;*OPC')
+    if not scpi.wait_opc(device, sweep_timeout, interval=poll_interval, max_interval=poll_max_interval,
+                         backoff=poll_backoff):
+        raise TimeoutError(f"扫描超过{sweep_timeout}秒没有完成")
+    logging.debug(f"扫描完成，用时{time.perf_counter() - start:.3f}秒")
+
 
+def fetch(device, channel=1):
+    """
+    读取本次扫描的数据
+    :param device: 设备对象
+    :param channel: 开关通道，每个通道使用自己的缓冲区
+    :return: (测量数据, 扫描点频率)
+    """
     # 对于查询命令，我们需要读取返回的数据
-    data_format =np.abs(device.query_binary_values('FORMAT REAL,32;:CALC:DATA:DALL? FDAT'))
-    trace_data = device.query_binary_values('TRAC:STIM? CH1DATA')
+    # 二进制块直接映射为 numpy 数组，不经过 python 列表
+    big_endian = byte_order(device)
+    raw = device.query_binary_values('FORMAT REAL,32;:CALC:DATA:DALL? FDAT', datatype='f',
+                                     is_big_endian=big_endian, container=np.ndarray)
+    # 取绝对值直接写入该通道的缓冲区
+    data_format = np.abs(raw, out=data_buffer(channel, raw.shape[0]))
+    # 扫描点频率只随配置变化，按配置指纹缓存，重新配置后才再读
+    state = visa_pool.session_state(device)
+    cached = state.get('stimulus')
+    if cached is not None and cached[0] == state.get('config'):
+        trace_data = cached[1]
+    else:
+        trace_data = device.query_binary_values('FORMAT REAL,64;:TRAC:STIM? CH1DATA', datatype='d',
+                                                is_big_endian=big_endian, container=np.ndarray)
+        trace_data.flags.writeable = False
+        state['stimulus'] = (state.get('config'), trace_data)
     # 打印接收的数据
     logging.debug(data_format)
     logging.debug(trace_data)
     return data_format, trace_data
 
 
+def get_data(device, channel=1):
+    # 触发一次扫描并读取数据
+    with timing.span("trigger"):
+        trigger(device)
+    with timing.span("fetch"):
+        return fetch(device, channel)
+
+
+def limits_for(channel):
+    """
+    :param channel: 通路名
+    :return: (下限线, 上限线)
+    """
+    try:
+        return limit_lines[str(channel)]
+    except KeyError:
+        raise ValueError(f"通路 {channel} 没有定义上下限") from None
+
+
 def plot_data(data_format, trace_data, channel=1):
     plt.plot(trace_data, data_format)
     plt.xlabel('Frequency (Hz)')
     plt.ylabel('Magnitude (dB)')
     plt.xscale('log')
     # 添加上下限制
-    if channel == 1:
-        plt.plot(trace_data,l1_lower , 'r--')
-        plt.plot(trace_data,l1_upper, 'r--')
-    else:
-        plt.plot(trace_data,l2_lower,  'r--')
-        plt.plot(trace_data,l2_upper,  'r--')
+    lower_line, upper_line = limits_for(channel)
+    plt.plot(trace_data, lower_line.at(trace_data), 'r--')
+    plt.plot(trace_data, upper_line.at(trace_data), 'r--')
     # 保存图片，按照当前时间命名
     plt.savefig(f'loss-channel{channel}-{time.time()}.png')
     plt.close()
 
 
-    rm = visa.ResourceManager()
-    try:
-        instrument = rm.open_resource(resource)
-        commands = []
-
-        if channel == 1:
-            commands = [
-                'ROUTE:CLOSE (@F01A11(0101))',
-                'ROUTE:CLOSE (@F01A11(0102))',
-                'ROUTE:CLOSE (@F01A12(0001))',
-                'ROUTE:CLOSE (@F01A12(0002))',
-                'ROUTE:CLOSE (@F01A13(0101))',
-                'ROUTE:CLOSE (@F01A13(0102))'
-            ]
-        elif channel == 2:
-            commands = [
-                'ROUTE:CLOSE (@F01A11(0001))',
-                'ROUTE:CLOSE (@F01A11(0002))',
-                'ROUTE:CLOSE (@F01A12(0101))',
-                'ROUTE:CLOSE (@F01A12(0102))',
-                'ROUTE:CLOSE (@F01A13(0201))',
-                'ROUTE:CLOSE (@F01A13(0202))'
-            ]
-        for cmd in commands:
-            instrument.write(cmd)
-
-    except visa.VisaIOError as e:
-        print(f"Error communicating with the device: {e}")
-    finally:
-        # Ensures that the connection is closed even if an error occurs
-        if 'instrument' in locals():
-            instrument.close()
-
-
-
-def create_data_point(i, j, freq, data_format):
-    lower = l1_lower if i == 1 else l2_lower
-    upper = l1_upper if i == 1 else l2_upper
-    category = "Loss-1" if i == 1 else "Loss-2"
-    return {
-        "Name": freq,
-        "Category": category,
-        "Lower": lower[j],
-        "Upper": upper[j],
-        "Value":data_format[j],
-        "Result": "PASS" if lower[j] <data_format[j] < upper[j] else "FAIL",
-        "Unit": "dB"
-    }
+def create_data_points(i, data_format, trace_data):
+    """
+    整条曲线一次向量运算判定，生成测试项
+    :param i: 通路名
+    :param data_format: 测量数据
+    :param trace_data: 扫描点频率(Hz)
+    :return: 测试项列表
+    """
+    category = f"Loss-{i}"
+    lower_line, upper_line = limits_for(i)
+    result = limits.evaluate(data_format, lower_line.at(trace_data), upper_line.at(trace_data), trace_data)
+    if not result.passed:
+        logging.debug(f"{category} 最差点 {result.worst_freq / 1000:g}kHz 余量 {result.worst_margin:.2f}dB")
+    points = result.points
+    return [
+        {
+            # 名称沿用 kHz 频率
+            "Name": int(freq) if freq.is_integer() else freq,
+            "Category": category,
+            "Lower": lower,
+            "Upper": upper,
+            "Value": value,
+            "Result": "PASS" if passed else "FAIL",
+            "Unit": "dB"
+        }
+        for freq, lower, upper, value, passed in zip(np.round(points['freq'] / 1000, 3).tolist(),
+                                                     points['lower'].tolist(), points['upper'].tolist(),
+                                                     points['value'].tolist(), points['passed'].tolist())
+    ]
+
+
+def settle_key(channel):
+    # 稳定时间按 模块:通道 记录
+    return f"{__name__}:{channel}"
+
+
+def sweep_level(device, channel):
+    # 扫描一次，用整条曲线的平均值判断是否稳定
+    data_format, trace_data = get_data(device, channel)
+    return float(data_format.mean())
+
+
+def route(channel):
+    """
+    切换开关，继电器有动作时等待稳定
+    :param channel: 开关通道
+    :return: 切换完成的时间(time.perf_counter())，继电器没有动作时返回 None
+    """
+    if not switch_channel(channel):
+        return None
+    switched = time.perf_counter()
+    timing.sleep(settling.delay(settle_key(channel), settle_time(channel)))
+    return switched
 
 
 def measure():
     try:
         device = connect_device(znl_resouce)
-        config(device)
+        # 扫描只设置一次，切换通道时不再重新下发
+        with timing.span("configure"):
+            config(device)
         data = []
-        for i in range(1, 3):
-            switch_channel(i)
-            time.sleep(0.5)  # consider replacing this with a more dynamic wait
-            data_format, trace_data = get_data(device)
-            plot_data(data_format, trace_data, i)
-            for j, freq in enumerate(frequency):
-                data_point = create_data_point(i, j, freq, data_format)
-                data.append(data_point)
+        # 在切换线程里执行的步骤也记录到本次测试的用时里
+        pending = _router.submit(contextvars.copy_context().run, route, channels[0])
+        for n, i in enumerate(channels):
+            set_step(f"CH{i}")
+            with timing.span("route"):
+                switched = pending.result()
+            if switched is not None and settling.mode == 'profile':
+                # 记录从切换到扫描结果稳定的时间
+                settling.wait_stable(lambda: sweep_level(device, i), profile_tolerance, profile_max_wait,
+                                     start=switched, key=settle_key(i))
+            with timing.span("trigger"):
+                trigger(device)
+            # 扫描完成后数据保存在仪器里，立即切换下一个通道，继电器稳定的时间和读数据、判定重叠
+            if n + 1 < len(channels):
+                pending = _router.submit(contextvars.copy_context().run, route, channels[n + 1])
+            with timing.span("fetch"):
+                data_format, trace_data = fetch(device, i)
+            with timing.span("plot"):
+                plot_data(data_format, trace_data, i)
+            data.extend(create_data_points(i, data_format, trace_data))
         close_device(device)
         return data
     except Exception as e:
@@ -206,13 +357,14 @@ def measure():
         return []
 
 
+@timing.traced
 def main():
-    write_plc("D5120", 0)
-    write_plc("D6121", 0)
+    write_plc_many({"D5120": 0, "D6121": 0})
     result = measure()
     results=[item["Result"] for item in result]
     final_result="PASS"
-    if "FAIL" in results:
+    # 出错时 measure 返回空列表，少了通道或频率点的数据同样按不合格处理
+    if "FAIL" in results or len(result) < len(channels) * len(frequency):
         write_plc("D6121", 2)
         final_result="FAIL"
     else:
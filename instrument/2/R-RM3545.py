@@ -1,11 +1,23 @@
-import pyvisa as visa
-from plc import write_plc
-import time
-from logger import logger as logging
+import visa_pool
+import scpi
+import settling
+import timing
+from plc import write_plc, write_plc_many, write_plc_async, flush_plc
+from logger import logger as logging, set_step
 
 
 rm3545_resouce = '''ASRL2::INSTR'''
 relay_delay =2
+# 读数稳定判断: 相对容差、最长等待时间(秒)、连续读数个数
+settle_tolerance = 0.01
+settle_max_wait = relay_delay + 2
+settle_count = 3
+# 两次读数的间隔(秒)，连续测量模式下 Fetch? 返回最近一次采样，间隔不小于一次采样时间才不会读到重复值
+settle_interval = 0.1
+# 写入步骤后继电器开始动作前的读数不可信，至少等待的时间(秒)
+relay_min_delay = 0.3
+# 上一项的读数。读数稳定在这个值上时分不清是夹具还没动作，这种情况至少等到 relay_delay
+last_value = None
 
 TestItems = [
     {
@@ -26,77 +38,85 @@ TestItems = [
 
 
 def connect_device(resource):
-    # 创建一个资源管理器
-    rm = visa.ResourceManager()
-    # 连接到指定的设备
-    device = rm.open_resource(resource)
-    # 判断连接是否成功
-    if device.query('*IDN?') == '':
-        logging.debug("连接失败")
-    else:
-        logging.debug("连接成功")
-    # 返回设备对象
-    return device
+    # 从会话池取出设备，会话在测试周期之间保持打开
+    return visa_pool.get_device(resource)
 
 
 def close_device(device):
-    # 关闭与仪器的连接
-    device.close()
+    # 归还设备，不关闭连接
+    visa_pool.release_device(device)
 
 
 def config(device):
-    device.write('*RST;*CLS;')
+    batch = scpi.CommandBatch(device)
+    batch.write('*RST;*CLS;')
     # device.write(':SYST:LFR 50;')
     
     # device.write(':SENS:FUNC RES;')
     # device.write(':RES:RANG 1.00E-3;')
     # device.write(':SAMP:RATE SLOW1;')
-    device.write(':INIT:CONT ON;')
+    batch.write(':INIT:CONT ON;')
+    with timing.span("configure"):
+        batch.flush()
 
 
 def measure(device):
     # 开始测量,等待测量完成
-    result = device.query('Fetch?')
+    with timing.span("fetch"):
+        result = device.query('Fetch?')
     return result
 
 
+def measure_settled(device, item):
+    global last_value
+    set_step(item['Name'])
+    # 确认切换步骤已经写到PLC，再连续读数直到稳定，稳定时间按 模块:测试项 记录
+    flush_plc()
+    settled = settling.settle(lambda: float(measure(device)), relay_delay, key=f"{__name__}:{item['Name']}",
+                              tolerance=settle_tolerance, max_wait=settle_max_wait,
+                              interval=settle_interval, count=settle_count, min_wait=relay_min_delay,
+                              previous=last_value, stale_wait=relay_delay)
+    last_value = settled.value
+    return settled
+
 
+@timing.traced
 def main():
     # 连接设备
     device = connect_device(rm3545_resouce)
     plc_step_address = 'D6085'
     # 收到后把D5085/D6086 置0
-    write_plc('D5085', 0)
-    write_plc('D6086', 0)
-
-    write_plc(plc_step_address, 0)
+    write_plc_many({'D5085': 0, 'D6086': 0, plc_step_address: 0})
     
     # 配置设备
     config(device)
-    time.sleep(relay_delay)
     # 测量DC+-DC+'的电阻值
-    result = measure(device)
-    result = float(result) * 1000
+    settled = measure_settled(device, TestItems[0])
+    result = settled.value * 1000
     TestItems[0]["Value"]=result
+    TestItems[0]["SettleTime"]=round(settled.settled_after, 3)
     if TestItems[0]["Lower"] < result < TestItems[0]["Upper"]:
         TestItems[0]["Result"] = "PASS"
     else:
         TestItems[0]["Result"] = "FAIL"
     logging.debug(result)
-    write_plc(plc_step_address, 1)
+    write_plc_async(plc_step_address, 1)
 
-    time.sleep(relay_delay)
     # 测量DC--DC-'的电阻值
-    result = measure(device)
-    result = float(result) * 1000
+    settled = measure_settled(device, TestItems[1])
+    result = settled.value * 1000
     TestItems[1]["Value"]=result
+    TestItems[1]["SettleTime"]=round(settled.settled_after, 3)
     if TestItems[1]["Lower"] < result < TestItems[1]["Upper"]:
         TestItems[1]["Result"] = "PASS"
     else:
         TestItems[1]["Result"] = "FAIL"
     logging.debug(result)
-    write_plc(plc_step_address, 2)
-    time.sleep(relay_delay)
+    write_plc_async(plc_step_address, 2)
+    # 给PLC处理最后一步的时间再通知完成，这是和PLC的握手时序，不是测量稳定等待
+    timing.sleep(relay_delay)
+    # 进度写完后再写结果
+    flush_plc()
     write_plc(plc_step_address, 10)
     final_result="PASS"
     # 如果有失败项，则向PLC写入PLC D6086 写入2，如果全部PASS则写入1
@@ -0,0 +1,75 @@
+# limits.py
+from collections import namedtuple
+import numpy as np
+
+# 每个点的判定结果
+point_dtype = np.dtype([
+    ('freq', 'f8'),
+    ('value', 'f8'),
+    ('lower', 'f8'),
+    ('upper', 'f8'),
+    # 到最近一条限值线的余量，小于等于0为不合格
+    ('margin', 'f8'),
+    ('passed', '?'),
+])
+
+# points: 结构化数组; passed: 整条曲线是否合格; worst_*: 余量最小的点
+LimitResult = namedtuple('LimitResult', ['points', 'passed', 'worst_index', 'worst_freq', 'worst_margin'])
+
+
+def evaluate(values, lower, upper, freqs):
+    """
+    一次向量运算判定整条曲线是否在上下限之间
+    :param values: 测量值数组
+    :param lower: 下限数组
+    :param upper: 上限数组
+    :param freqs: 频率数组
+    :return: LimitResult
+    """
+    values = np.asarray(values, dtype='f8')
+    points = np.empty(values.shape[0], dtype=point_dtype)
+    points['freq'] = freqs
+    points['value'] = values
+    points['lower'] = lower
+    points['upper'] = upper
+    np.minimum(values - points['lower'], points['upper'] - values, out=points['margin'])
+    np.greater(points['margin'], 0, out=points['passed'])
+    if points.shape[0] == 0:
+        return LimitResult(points, True, -1, None, None)
+    worst = int(np.argmin(points['margin']))
+    return LimitResult(points, bool(points['passed'].all()), worst,
+                       float(points['freq'][worst]), float(points['margin'][worst]))
+
+
+class LimitLine:
+    """
+    用 (频率, 限值) 折点定义的限值线，在对数频率上插值到实际的扫描点
+    扫描点不变时直接使用缓存的插值结果
+    """
+
+    # 最多缓存多少组扫描点
+    cache_size = 8
+
+    def __init__(self, freqs, values):
+        freqs = np.asarray(freqs, dtype='f8')
+        order = np.argsort(freqs)
+        self._log_freqs = np.log10(freqs[order])
+        self._values = np.asarray(values, dtype='f8')[order]
+        self._cache = {}
+
+    def at(self, stimulus):
+        """
+        :param stimulus: 扫描点频率数组，单位和折点一致
+        :return: 每个扫描点的限值(只读数组)
+        """
+        stimulus = np.asarray(stimulus, dtype='f8')
+        key = stimulus.tobytes()
+        line = self._cache.get(key)
+        if line is None:
+            # 折点范围以外取端点的限值
+            line = np.interp(np.log10(stimulus), self._log_freqs, self._values)
+            line.flags.writeable = False
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = line
+        return line
@@ -1,29 +1,112 @@
 ﻿# logger.py
+import atexit
+import contextvars
+from contextlib import contextmanager
+import datetime
+import json
 import os
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# 日志级别
+log_level = logging.INFO
+# 日志目录，默认是运行目录下的 logs，可以用环境变量 LOG_DIR 指定
+log_directory = os.environ.get("LOG_DIR", "logs")
+
+# 当前日志上下文: station 测试站(模块名)、step 测试步骤、resource 仪器地址，_start 进入时间
+_context = contextvars.ContextVar("log_context", default=None)
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    with log_context(station=..., resource=...): 这段代码里写的日志都带上这些字段
+    elapsed 从最外层的 log_context 进入时开始计时
+    """
+    parent = _context.get()
+    context = dict(parent) if parent else {"_start": time.perf_counter()}
+    context.update(fields)
+    token = _context.set(context)
+    try:
+        yield context
+    finally:
+        _context.reset(token)
+
+
+def set_step(step):
+    # 设置当前测试步骤，之后写的日志都带上该步骤
+    context = _context.get()
+    if context is not None:
+        context["step"] = step
+
+
+class ContextFilter(logging.Filter):
+    """
+    在调用线程把日志上下文附加到日志记录上，只取值不做格式化
+    """
+
+    def filter(self, record):
+        context = _context.get()
+        if context is None:
+            record.station = record.step = record.resource = record.elapsed = None
+        else:
+            record.station = context.get("station")
+            record.step = context.get("step")
+            record.resource = context.get("resource")
+            record.elapsed = round(time.perf_counter() - context["_start"], 4)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志一行 JSON，在后台线程格式化
+    (异常堆栈已经由 QueueHandler 在入队时合并到 message 里)
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "station": getattr(record, "station", None),
+            "step": getattr(record, "step", None),
+            "resource": getattr(record, "resource", None),
+            "elapsed": getattr(record, "elapsed", None),
+            "message": record.getMessage(),
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
 
 def setup_logger():
-    log_directory = "logs"
     if not os.path.exists(log_directory):
         os.makedirs(log_directory)
 
     mylogger = logging.getLogger("my-logger")
-    mylogger.setLevel(logging.INFO)
+    mylogger.setLevel(log_level)
 
-    # 构造文件路径
-    log_file_path = os.path.join(log_directory, "app.log")
+    # 构造文件路径，JSON lines 格式
+    log_file_path = os.path.join(log_directory, "app.jsonl")
 
-    # 创建一个滚动日志处理器
+    # 创建一个滚动日志处理器，只在后台线程里使用
     handler = RotatingFileHandler(
-        log_file_path, maxBytes=1048576, backupCount=5  # 文件大小为1MB，保留5个备份
+        log_file_path, maxBytes=1048576, backupCount=5, encoding="utf-8"  # 文件大小为1MB，保留5个备份
     )
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
-    handler.setFormatter(formatter)
-    mylogger.addHandler(handler)
+    handler.setFormatter(JsonFormatter())
+
+    # 调用线程只把日志记录放进队列，格式化和写文件由后台线程完成
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    mylogger.addHandler(queue_handler)
+    mylogger.propagate = False
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    # 进程退出时写完队列里剩下的日志
+    atexit.register(listener.stop)
     return mylogger
 
 
@@ -1,8 +1,62 @@
-﻿import importlib
-from fastapi import FastAPI, HTTPException
+﻿import asyncio
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
+import logger
+import plc
+import registry
+import scpi
+import settling
 
 app = FastAPI()
+# 启动时一次性加载所有仪器脚本
+registry.load()
+
+# 每台仪器一条串行通道(单线程)，不同仪器之间并行执行
+lanes = {
+    resource: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"lane-{resource}")
+    for resource in set(registry.resources.values()) if resource is not None
+}
+# 没有仪器的脚本共用一个小线程池
+default_lane = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lane-default")
+
+# 每台仪器最多允许多少个请求在执行+排队，超过直接返回忙，避免 SCPI 命令交错
+max_pending = 2
+# 忙时建议 PLC 重试的间隔(秒)
+retry_after = 1
+
+_stats_lock = threading.Lock()
+# 通道 -> 排队统计
+lane_stats = {
+    name: {"pending": 0, "running": 0, "completed": 0, "rejected": 0,
+           "last_wait": 0.0, "max_wait": 0.0, "total_wait": 0.0}
+    for name in list(lanes) + ["default"]
+}
+
+
+def _run(name, enqueued, func, kwargs):
+    # 在通道线程里执行，记录排队等待时间
+    wait = time.monotonic() - enqueued
+    with _stats_lock:
+        stats = lane_stats[name]
+        stats["running"] += 1
+        stats["last_wait"] = wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        stats["total_wait"] += wait
+    try:
+        # 这次调用里写的日志都带上测试站和仪器地址
+        with logger.log_context(station=func.__module__, resource=None if name == "default" else name):
+            result = func(**kwargs)
+        # 结果里的 TestItems 是模块全局变量，复制一份再交出去，下一次测试改写时不受影响
+        return copy.deepcopy(result), wait
+    finally:
+        with _stats_lock:
+            stats["running"] -= 1
+            stats["pending"] -= 1
+            stats["completed"] += 1
 
 
 @app.get("/")
@@ -17,20 +71,72 @@ class FunctionCall(BaseModel):
 
 
 @app.post("/call-function/")
-async def call_function(data: FunctionCall):
-    # 动态调用本地python代
-    try:
-        # 替换路径中/或者\为.
-        data.module_path = (data.module_path
-                            .replace("/", ".")
-                            .replace("\\", ".")
-                            .replace(".py", ""))
-        module = importlib.import_module(data.module_path)
-        func = getattr(module, data.function_name)
-        return func(**data.kwargs)
-    except ModuleNotFoundError:
-        raise HTTPException(status_code=404, detail="Module not found")
-    except AttributeError:
+async def call_function(data: FunctionCall, response: Response):
+    # 查表调用本地python代码
+    func = registry.dispatch.get((data.module_path, data.function_name))
+    if func is None:
+        if data.module_path in registry.failed:
+            raise HTTPException(status_code=500, detail=registry.failed[data.module_path])
+        if data.module_path not in registry.modules:
+            raise HTTPException(status_code=404, detail="Module not found")
         raise HTTPException(status_code=404, detail="Function not found")
+    # 阻塞的仪器调用放到对应仪器的通道里排队执行，不占用事件循环
+    resource = registry.resources[data.module_path]
+    if resource in lanes:
+        name, lane = resource, lanes[resource]
+    else:
+        name, lane = "default", default_lane
+    with _stats_lock:
+        stats = lane_stats[name]
+        if name != "default" and stats["pending"] >= max_pending:
+            stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail={"message": "仪器忙", "resource": resource, "queue_depth": stats["pending"]},
+                headers={"Retry-After": str(retry_after)},
+            )
+        stats["pending"] += 1
+        depth = stats["pending"] - 1
+    loop = asyncio.get_running_loop()
+    try:
+        result, wait = await loop.run_in_executor(lane, _run, name, time.monotonic(), func, data.kwargs)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    response.headers["X-Queue-Depth"] = str(depth)
+    response.headers["X-Queue-Wait"] = f"{wait:.3f}"
+    return result
+
+
+@app.get("/scheduler/")
+async def scheduler():
+    # 各仪器通道的排队深度和等待时间
+    with _stats_lock:
+        return {
+            name: dict(stats, avg_wait=stats["total_wait"] / stats["completed"] if stats["completed"] else 0.0)
+            for name, stats in lane_stats.items()
+        }
+
+
+@app.get("/plc/stats/")
+async def plc_stats():
+    # PLC 写入次数和耗时统计
+    return plc.get_stats()
+
+
+@app.get("/scpi/stats/")
+async def scpi_stats():
+    # SCPI 批量下发节省的往返次数
+    return scpi.get_stats()
+
+
+@app.get("/settling/profile/")
+async def settling_profile():
+    # 各通路继电器稳定时间的分布
+    return settling.get_profile()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    for lane in lanes.values():
+        lane.shutdown(wait=False)
+    default_lane.shutdown(wait=False)
@@ -1,15 +1,164 @@
 ﻿from logger import logger as logging
+import threading
+import time
 import requests
+import timing
+from requests.adapters import HTTPAdapter
+
+# Node-RED 写PLC的接口
+plc_url = 'http://127.0.0.1:1880/plc/set'
+# Node-RED 批量写PLC的接口
+# 请求体: [{"address": "D5080", "value": 0}, ...]，按顺序写入
+# 返回: {"D5080": true, ...} 每个地址是否写入成功
+plc_batch_url = 'http://127.0.0.1:1880/plc/set-many'
+# (连接超时, 读取超时) 秒
+timeout = (1.0, 2.0)
+# 连接失败/超时后的重试次数
+retries = 2
+# 重试间隔(秒)
+retry_delay = 0.05
+
+# 所有驱动共用一个会话，保持长连接，不再每次写入都重新建立TCP连接
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+_stats_lock = threading.Lock()
+_stats = {"count": 0, "failed": 0, "retried": 0, "total_time": 0.0, "max_time": 0.0, "last_time": 0.0}
+
+
+def _record(elapsed, ok):
+    with _stats_lock:
+        _stats["count"] += 1
+        if not ok:
+            _stats["failed"] += 1
+        _stats["total_time"] += elapsed
+        _stats["max_time"] = max(_stats["max_time"], elapsed)
+        _stats["last_time"] = elapsed
+
+
+def get_stats():
+    # PLC 写入次数和耗时统计
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["avg_time"] = stats["total_time"] / stats["count"] if stats["count"] else 0.0
+    return stats
+
+
+def _post(url, **kwargs):
+    # 发送请求，连接失败/超时按配置重试，最终失败返回 None
+    with timing.span("plc"):
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                response = _session.post(url=url, timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                _record(time.perf_counter() - start, False)
+                if attempt < retries:
+                    with _stats_lock:
+                        _stats["retried"] += 1
+                    time.sleep(retry_delay)
+                    continue
+                logging.error(f"{url} 请求失败: {e}")
+                return None
+            _record(time.perf_counter() - start, response.status_code == 200)
+            return response
 
 
 def write_plc(address, value):
     # 写入plc
-    url = f'http://127.0.0.1:1880/plc/set'
     data = {'address': address, 'value': value}
-    response = requests.post(url=url, data=data)
-    if response.status_code == 200:
+    response = _post(plc_url, data=data)
+    if response is not None and response.status_code == 200:
         logging.debug(f"{address}:{value}写入成功")
         return True
     else:
         logging.debug(f"{address}:{value}写入失败")
         return False
+
+
+# Node-RED 没有批量接口时退回逐个写入
+_batch_supported = True
+
+
+def write_plc_many(values):
+    """
+    一次请求写入多个寄存器
+    :param values: {地址: 值}，按字典顺序写入
+    :return: {地址: 是否写入成功}
+    """
+    global _batch_supported
+    if _batch_supported:
+        data = [{'address': address, 'value': value} for address, value in values.items()]
+        response = _post(plc_batch_url, json=data)
+        if response is not None and response.status_code in (404, 405):
+            logging.info("Node-RED 没有批量写入接口，改为逐个写入")
+            _batch_supported = False
+        elif response is not None and response.status_code == 200:
+            try:
+                reply = response.json()
+            except ValueError:
+                reply = None
+            if isinstance(reply, dict):
+                results = {address: bool(reply.get(address, False)) for address in values}
+            else:
+                results = dict.fromkeys(values, True)
+            logging.debug(f"{values}批量写入结果: {results}")
+            return results
+        else:
+            logging.debug(f"{values}批量写入失败")
+            return dict.fromkeys(values, False)
+    return {address: write_plc(address, value) for address, value in values.items()}
+
+
+# 后台写入队列: 地址 -> 最新值，同一地址的多次写入只保留最后一次
+_pending = {}
+_pending_cond = threading.Condition()
+_writing = False
+_writer = None
+
+
+def _writer_loop():
+    global _writing
+    while True:
+        with _pending_cond:
+            while not _pending:
+                _pending_cond.wait()
+            values = dict(_pending)
+            _pending.clear()
+            _writing = True
+        try:
+            if len(values) == 1:
+                write_plc(*next(iter(values.items())))
+            else:
+                write_plc_many(values)
+        except Exception as e:
+            logging.error(f"{values}后台写入失败: {e}")
+        finally:
+            with _pending_cond:
+                _writing = False
+                _pending_cond.notify_all()
+
+
+def write_plc_async(address, value):
+    """
+    不等待结果的写入，用于测试步骤、状态等进度寄存器
+    :param address: PLC地址
+    :param value: 写入值
+    """
+    global _writer
+    with _pending_cond:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="plc-writer", daemon=True)
+            _writer.start()
+        _pending[address] = value
+        _pending_cond.notify_all()
+
+
+def flush_plc(timeout=5.0):
+    """
+    等待后台队列写完，最终的合格/不合格握手之前调用
+    :param timeout: 最长等待时间(秒)
+    :return: 是否全部写完
+    """
+    with timing.span("plc"), _pending_cond:
+        return _pending_cond.wait_for(lambda: not _pending and not _writing, timeout)
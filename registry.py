@@ -0,0 +1,91 @@
+# registry.py
+import importlib.util
+import inspect
+import os
+import sys
+from logger import logger as logging
+
+# 仪器脚本所在目录，文件夹名是数字、文件名带连字符，只能按文件路径加载
+instrument_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instrument")
+
+# 模块路径(各种写法) -> 模块
+modules = {}
+# 加载失败的模块路径 -> 错误信息
+failed = {}
+# (模块路径, 函数名) -> 函数，请求直接查表调用
+dispatch = {}
+# 模块路径 -> 模块使用的仪器资源地址
+resources = {}
+
+
+def _aliases(rel_path):
+    # 兼容请求里的 instrument/2/LC-E4980A.py、instrument\2\LC-E4980A、instrument.2.LC-E4980A 等写法
+    stem = rel_path[:-len(".py")]
+    aliases = []
+    for sep in ("/", "\\", "."):
+        name = stem.replace("/", sep)
+        aliases.append(name)
+        aliases.append(name + ".py")
+    return aliases
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def _find_resource(module):
+    # 各脚本用 xxx_resouce 全局变量保存仪器地址
+    for name, value in vars(module).items():
+        if name.endswith(("_resouce", "_resource")) and isinstance(value, str):
+            return value
+    return None
+
+
+def load():
+    """
+    启动时加载 instrument 下的所有脚本，每个脚本只加载一次，生成调用表
+    """
+    modules.clear()
+    failed.clear()
+    dispatch.clear()
+    resources.clear()
+    for folder in sorted(os.listdir(instrument_dir)):
+        folder_path = os.path.join(instrument_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for file_name in sorted(os.listdir(folder_path)):
+            if not file_name.endswith(".py"):
+                continue
+            rel_path = f"instrument/{folder}/{file_name}"
+            aliases = _aliases(rel_path)
+            # 模块名沿用原来 import_module 时的 instrument.2.LC-E4980A
+            module_name = rel_path[:-len(".py")].replace("/", ".")
+            try:
+                module = _load_module(module_name, os.path.join(folder_path, file_name))
+            except Exception as e:
+                logging.error(f"{rel_path} 加载失败: {e}")
+                for alias in aliases:
+                    failed[alias] = str(e)
+                continue
+            # 只开放模块自己定义的公开普通函数，import 进来的 write_plc 等不能通过请求调用，
+            # 生成器和协程函数调用后返回的对象无法作为结果返回
+            functions = {
+                name: obj for name, obj in vars(module).items()
+                if inspect.isfunction(obj) and not name.startswith("_") and obj.__module__ == module_name
+                and not inspect.isgeneratorfunction(obj) and not inspect.iscoroutinefunction(obj)
+            }
+            resource = _find_resource(module)
+            for alias in aliases:
+                modules[alias] = module
+                resources[alias] = resource
+                for name, func in functions.items():
+                    dispatch[(alias, name)] = func
+            logging.info(f"{rel_path} 已加载: {', '.join(sorted(functions))}")
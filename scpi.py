@@ -0,0 +1,137 @@
+# scpi.py
+import asyncio
+import threading
+import time
+
+# 仪器输入缓冲区默认长度(字节)，拼接后的一次写入不超过该长度
+default_max_length = 512
+
+_stats_lock = threading.Lock()
+_stats = {"commands": 0, "writes": 0}
+
+
+def get_stats():
+    # 批量下发的命令数、实际写入次数和节省的往返次数
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["saved"] = stats["commands"] - stats["writes"]
+    return stats
+
+
+def poll(check, timeout, interval=0.005, max_interval=0.2, backoff=1.5):
+    """
+    按逐渐加长的间隔轮询，直到 check() 返回真值或超时
+    :param check: 查询函数
+    :param timeout: 超时时间(秒)
+    :param interval: 第一次轮询间隔(秒)
+    :param max_interval: 最大轮询间隔(秒)
+    :param backoff: 每次间隔放大的倍数
+    :return: check() 的返回值，超时返回 None
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+async def poll_async(check, timeout, interval=0.005, max_interval=0.2, backoff=1.5):
+    """
+    poll 的异步版本，check() 在线程池里执行，等待期间不占用事件循环
+    :param check: 查询函数
+    :param timeout: 超时时间(秒)
+    :param interval: 第一次轮询间隔(秒)
+    :param max_interval: 最大轮询间隔(秒)
+    :param backoff: 每次间隔放大的倍数
+    :return: check() 的返回值，超时返回 None
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = await asyncio.to_thread(check)
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+def wait_opc(device, timeout=10, **kwargs):
+    """
+    等待 *OPC 置位事件状态寄存器的 OPC 位(bit 0)，命令里需要先 *CLS 再以 *OPC 结尾
+    :param device: 设备对象
+    :param timeout: 超时时间(秒)
+    :return: 是否完成
+    """
+    return bool(poll(lambda: int(float(device.query('*ESR?'))) & 1, timeout, **kwargs))
+
+
+class CommandBatch:
+    """
+    把多条 SCPI 命令用 ; 拼接，尽量少次写入仪器
+    with scpi.CommandBatch(device) as batch:
+        batch.write(':FREQ 1000')
+        batch.write(':VOLT 1')
+    """
+
+    def __init__(self, device, max_length=default_max_length):
+        self.device = device
+        self.max_length = max_length
+        self.commands = 0
+        self.writes = 0
+        self._queue = []
+        self._length = 0
+
+    @property
+    def saved(self):
+        # 节省的往返次数
+        return self.commands - self.writes
+
+    def write(self, command):
+        """
+        加入一条命令(只能是设置命令，查询命令直接用 device.query)
+        :param command: SCPI 命令
+        """
+        command = command.strip().rstrip(';').strip()
+        if not command:
+            return
+        # 拼接后 ; 之后的命令按上一条命令的路径解析，统一从根路径开始
+        if not command.startswith((':', '*')):
+            command = ':' + command
+        if self._queue and self._length + 1 + len(command) > self.max_length:
+            self.flush()
+        self._length += len(command) + (1 if self._queue else 0)
+        self._queue.append(command)
+        self.commands += 1
+
+    def flush(self):
+        # 下发排队的命令
+        if not self._queue:
+            return
+        message = ';'.join(self._queue)
+        count = len(self._queue)
+        self._queue = []
+        self._length = 0
+        self.device.write(message)
+        self.writes += 1
+        with _stats_lock:
+            _stats["commands"] += count
+            _stats["writes"] += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 出错时丢弃没有下发的命令
+        if exc_type is None:
+            self.flush()
+        else:
+            self._queue = []
+            self._length = 0
+        return False
@@ -0,0 +1,182 @@
+# settling.py
+import atexit
+from collections import namedtuple
+import json
+import math
+import os
+import threading
+import time
+import timing
+from logger import logger as logging, log_directory
+
+# detect: 连续读数直到稳定; fixed: 按固定延时等待后读一次(原来的做法)
+# profile: 同 detect，并记录每个通路从切换到读数稳定的时间
+# adaptive: 按记录的稳定时间分布取 percentile 分位数作为延时，等待后读一次
+mode = 'detect'
+# adaptive 模式使用的分位数
+percentile = 95
+# 记录少于该数量时 adaptive 模式仍使用原来的固定延时
+min_samples = 20
+# 每个通路最多保留的记录数，超过后丢弃最早的
+max_samples = 1000
+# 稳定时间分布的保存文件
+profile_file = os.path.join(log_directory, "settle_profile.json")
+# 每记录多少次保存一次文件，进程退出时也会保存
+save_every = 10
+
+# value: 最后一次读数; elapsed: 从开始等待到最后一次读数的时间(秒)
+# stable: 是否在最长等待时间内稳定; readings: 读数次数
+# settled_after: 从开始等待到稳定窗口第一个读数返回的时间(秒)，即实际的稳定时间
+Settled = namedtuple('Settled', ['value', 'elapsed', 'stable', 'readings', 'settled_after'])
+
+_lock = threading.Lock()
+# 通路 -> 稳定时间记录(秒)
+_profile = None
+_unsaved = 0
+
+
+def _load():
+    # 第一次使用时读取保存的分布
+    global _profile
+    if _profile is None:
+        _profile = {}
+        if os.path.exists(profile_file):
+            try:
+                with open(profile_file, encoding='utf-8') as f:
+                    _profile = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"{profile_file} 读取失败: {e}")
+    return _profile
+
+
+def save_profile():
+    # 保存稳定时间分布
+    global _unsaved
+    with _lock:
+        if _profile is None or _unsaved == 0:
+            return
+        data = json.dumps(_profile)
+        _unsaved = 0
+    os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+    with open(profile_file, 'w', encoding='utf-8') as f:
+        f.write(data)
+
+
+def record(key, seconds):
+    """
+    记录一次稳定时间
+    :param key: 通路，一般是 模块名:测试项
+    :param seconds: 从切换到读数稳定的时间(秒)
+    """
+    global _unsaved
+    with _lock:
+        samples = _load().setdefault(key, [])
+        samples.append(round(seconds, 4))
+        del samples[:-max_samples]
+        _unsaved += 1
+        save = _unsaved >= save_every
+    if save:
+        save_profile()
+
+
+def _percentile(samples, p):
+    # 最近秩法取分位数
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def delay(key, default):
+    """
+    切换后需要等待的时间
+    :param key: 通路
+    :param default: 没有足够记录时的固定延时(秒)
+    :return: 延时(秒)，profile 模式返回 0，由调用方记录实际的稳定时间
+    """
+    if mode == 'profile':
+        return 0
+    if mode == 'adaptive':
+        with _lock:
+            samples = _load().get(key)
+            if samples and len(samples) >= min_samples:
+                return _percentile(samples, percentile)
+    return default
+
+
+def get_profile():
+    """
+    查询各通路稳定时间的分布
+    :return: {通路: {count, min, p50, percentile, max}}
+    """
+    with _lock:
+        profile = {key: list(samples) for key, samples in _load().items()}
+    return {key: {"count": len(samples), "min": min(samples), "p50": _percentile(samples, 50),
+                  f"p{percentile}": _percentile(samples, percentile), "max": max(samples)}
+            for key, samples in profile.items() if samples}
+
+
+def wait_stable(read, tolerance, max_wait, interval=0.0, count=2, min_wait=0.0, start=None, key=None,
+                previous=None, stale_wait=0.0):
+    """
+    快速重复读数，直到最近 count 个读数都在容差窗口内，或超过最长等待时间
+    :param read: 读数函数，返回数值
+    :param tolerance: 相对容差，窗口内最大值和最小值之差不超过 tolerance * |均值|
+    :param max_wait: 最长等待时间(秒)
+    :param interval: 两次读数之间的间隔(秒)
+    :param count: 判断稳定用的连续读数个数
+    :param min_wait: 开始读数前至少等待的时间(秒)，继电器动作前的读数不可信，profile 模式不等待，记录实际的稳定时间
+    :param start: 开始计时的时间(time.perf_counter())，默认为现在，切换和读数不在一起时传入切换的时间
+    :param key: 通路，profile 模式下记录稳定时间
+    :param previous: 上一项的读数，稳定在这个值上可能是夹具还没动作
+    :param stale_wait: 读数稳定在 previous 上时，至少等到这个时间(秒)才算稳定
+    :return: Settled
+    """
+    if start is None:
+        start = time.perf_counter()
+    wait = start + min_wait - time.perf_counter()
+    if wait > 0 and mode != 'profile':
+        timing.sleep(wait)
+    window = []
+    readings = 0
+    while True:
+        value = read()
+        readings += 1
+        elapsed = time.perf_counter() - start
+        window.append((value, elapsed))
+        if len(window) > count:
+            window.pop(0)
+        if len(window) == count:
+            values = [v for v, _ in window]
+            mean = sum(values) / count
+            stale = previous is not None and abs(mean - previous) <= tolerance * abs(mean)
+            if max(values) - min(values) <= tolerance * abs(mean) and not (stale and elapsed < stale_wait):
+                settled = Settled(value, elapsed, True, readings, window[0][1])
+                break
+        if elapsed >= max_wait:
+            logging.warning(f"读数 {max_wait} 秒内没有稳定: {[v for v, _ in window]}")
+            settled = Settled(value, elapsed, False, readings, elapsed)
+            break
+        if interval > 0:
+            timing.sleep(interval)
+    # 没有稳定的不记录，避免把接触不良等异常算进分布
+    if key is not None and mode == 'profile' and settled.stable:
+        record(key, settled.settled_after)
+    return settled
+
+
+def settle(read, delay_time, key=None, **kwargs):
+    """
+    按 mode 等待读数稳定
+    :param read: 读数函数，返回数值
+    :param delay_time: fixed 模式的固定延时(秒)，adaptive 模式没有足够记录时也使用
+    :param key: 通路，profile 模式记录稳定时间，adaptive 模式按记录取延时
+    :param kwargs: wait_stable 的参数
+    :return: Settled
+    """
+    if mode in ('fixed', 'adaptive'):
+        wait = delay_time if mode == 'fixed' else delay(key, delay_time)
+        timing.sleep(wait)
+        return Settled(read(), wait, True, 1, wait)
+    return wait_stable(read, key=key, **kwargs)
+
+
+atexit.register(save_profile)
@@ -1,47 +1,100 @@
+import json
+import os
 import pyvisa as visa
-import logging
-import requests
-import time
-import logger as logging
+from logger import logger as logging
+import timing
+import visa_pool
+
+# 通路定义文件: {通路名: {"relays": [需要闭合的继电器, ...], "settle_time": 稳定时间(秒)}}
+routes_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes.json")
+# 没有标定的通路使用的稳定时间(秒)
+default_settle_time = 0.5
+
+# 通路名 -> 该通路需要闭合的继电器集合
+routes = {}
+# 通路名 -> 切换后继电器的稳定时间(秒)，按实测标定
+settle_times = {}
+# (当前通路名, 目标通路名) -> 切换命令，当前通路为 None 表示不知道开关状态
+_commands = {}
+
+
+def _channel_list(relays):
+    return '(@' + ','.join(sorted(relays)) + ')'
+
+
+def route_command(closed, target):
+    """
+    计算从当前闭合的继电器切换到目标通路的命令，先断开不需要的再闭合缺少的
+    :param closed: 当前闭合的继电器集合，None 表示不知道开关状态
+    :param target: 目标通路的继电器集合
+    :return: 一条命令，已经是目标通路时返回空字符串
+    """
+    if closed is None:
+        # 刚连接时不知道开关状态，断开其他通路的所有继电器，闭合目标通路的所有继电器
+        to_open = frozenset(relay for relays in routes.values() for relay in relays) - target
+        to_close = target
+    else:
+        to_open = closed - target
+        to_close = target - closed
+    commands = []
+    if to_open:
+        commands.append(f'ROUTE:OPEN {_channel_list(to_open)}')
+    if to_close:
+        commands.append(f'ROUTE:CLOSE {_channel_list(to_close)}')
+    return ';:'.join(commands)
+
+
+def load_routes(path=None):
+    """
+    读取通路定义文件，预先生成所有通路之间的切换命令
+    :param path: 通路定义文件，默认 routes_file
+    """
+    with open(path or routes_file, encoding='utf-8') as f:
+        table = json.load(f)
+    routes.clear()
+    settle_times.clear()
+    _commands.clear()
+    for name, route in table.items():
+        routes[name] = frozenset(route["relays"])
+        settle_times[name] = route.get("settle_time", default_settle_time)
+    for name, target in routes.items():
+        _commands[(None, name)] = route_command(None, target)
+        for current, closed in routes.items():
+            _commands[(current, name)] = route_command(closed, target)
+
+
+def settle_time(channel):
+    # 查询通路的继电器稳定时间
+    return settle_times.get(str(channel), default_settle_time)
 
 
 def switch_channel(channel=1, resource='TCPIP::192.168.48.147::INSTR'):
-    rm = visa.ResourceManager()
+    """
+    切换到指定通路，只动作和当前状态不同的继电器
+    :param channel: 通路名，通道号 1、2 等同于 "1"、"2"
+    :param resource: 开关资源地址
+    :return: 继电器是否有动作，没有动作时不需要等待稳定；通信失败时抛出 VisaIOError
+    """
+    name = str(channel)
+    if name not in routes:
+        raise ValueError(f"{routes_file} 里没有定义通路 {name}")
     try:
-        instrument = rm.open_resource(resource)
-        commands = []
-
-        if channel == 1:
-            commands = [
-                'ROUTE:CLOSE (@F01A11(0101))',
-                'ROUTE:CLOSE (@F01A11(0102))',
-                'ROUTE:CLOSE (@F01A12(0001))',
-                'ROUTE:CLOSE (@F01A12(0002))',
-                'ROUTE:CLOSE (@F01A13(0101))',
-                'ROUTE:CLOSE (@F01A13(0102))'
-            ]
-        elif channel == 2:
-            commands = [
-                'ROUTE:CLOSE (@F01A11(0001))',
-                'ROUTE:CLOSE (@F01A11(0002))',
-                'ROUTE:CLOSE (@F01A12(0101))',
-                'ROUTE:CLOSE (@F01A12(0102))',
-                'ROUTE:CLOSE (@F01A13(0201))',
-                'ROUTE:CLOSE (@F01A13(0202))'
-            ]
-        
-        # Send commands one by one
-        for cmd in commands:
-            instrument.write(cmd)
-            # Optionally add a delay or read back responses where necessary
-            # response = instrument.read()  # if feedback is needed
-            # print(response)
-
+        # 从会话池取出开关，不再每次切换都重新连接
+        instrument = visa_pool.get_device(resource)
+        # 会话重新连接后状态清空，按不知道开关状态处理
+        state = visa_pool.session_state(instrument)
+        command = _commands[(state.get('route'), name)]
+        if command:
+            with timing.span("switch"):
+                instrument.write(command)
+            state['route'] = name
+        visa_pool.release_device(instrument)
+        return bool(command)
     except visa.VisaIOError as e:
-        print(f"Error communicating with the device: {e}")
-    finally:
-        # Ensures that the connection is closed even if an error occurs
-        if 'instrument' in locals():
-            instrument.close()
-    
-    
\ No newline at end of file
+        logging.error(f"开关 {resource} 通信失败: {e}")
+        # 丢弃出错的会话，下次切换时重新连接；不能返回 False，否则会当作通路已经接好继续测量
+        visa_pool.invalidate(resource)
+        raise
+
+
+load_routes()
@@ -0,0 +1,9 @@
+# conftest.py
+import os
+import sys
+import tempfile
+
+# 被测模块都在仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 测试写的日志和稳定时间分布不放进仓库的 logs 目录，要在导入 logger 之前设置
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="logs-"))
@@ -0,0 +1,96 @@
+# test_hipot.py
+import importlib.util
+import os
+import pyvisa as visa
+import pytest
+
+RECORD = '+1,+1,"DCW",+2024,+5,+6,+7,+8,+9.5,+1.50E+03,+1.2E-04,+1.25E+07,+3.0,"PASS"'
+
+
+@pytest.fixture
+def hipot(monkeypatch):
+    # 文件名带连字符，按文件路径加载
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "instrument", "1", "HIPOT-TOS9301.py")
+    spec = importlib.util.spec_from_file_location("hipot_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "poll_interval", 0.001)
+    return module
+
+
+class FakeTos:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.statuses = iter([1 << 5, (1 << 9) | 1])
+        self.results = [RECORD]
+
+    def write(self, command):
+        if self.fail:
+            raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+
+    def query(self, command):
+        if command.startswith('STAT:OPER:TEST:COND?'):
+            return f"+{next(self.statuses)}\n"
+        if command.startswith('RES:COUN?'):
+            return '+0\n'
+        if command.startswith('RES:REM?'):
+            return self.results.pop(0) if self.results else '+0\n'
+        return '1\n'
+
+
+@pytest.fixture
+def pool(hipot, monkeypatch):
+    calls = []
+    monkeypatch.setattr(hipot.visa_pool, "release_device", lambda device: calls.append("release"))
+    monkeypatch.setattr(hipot.visa_pool, "invalidate", lambda resource: calls.append("invalidate"))
+    return calls
+
+
+def test_parse_test_result(hipot):
+    result = hipot.parse_test_result(RECORD)
+    assert result.func == "DCW"
+    assert result.judg == "PASS"
+    assert (result.year, result.month, result.day) == (2024, 5, 6)
+    assert result.sec == 9.5
+    assert result.curr == pytest.approx(1.2e-4)
+
+
+def test_measure_releases_session(hipot, pool, monkeypatch):
+    monkeypatch.setattr(hipot.visa_pool, "get_device", lambda resource: FakeTos())
+    results = hipot.measure("TCPIP0::test::INSTR")
+    assert [r.judg for r in results] == ["PASS"]
+    assert pool == ["release"]
+
+
+def test_measure_invalidates_session_on_io_error(hipot, pool, monkeypatch):
+    monkeypatch.setattr(hipot.visa_pool, "get_device", lambda resource: FakeTos(fail=True))
+    with pytest.raises(visa.VisaIOError):
+        hipot.measure("TCPIP0::test::INSTR")
+    # 出错的会话不能归还，下次测试重新连接
+    assert pool == ["invalidate"]
+
+
+class StatusDevice:
+    def __init__(self, response):
+        self.response = response
+
+    def query(self, command):
+        return self.response
+
+
+def test_test_status_decodes_signed_word(hipot):
+    # 最高位置位时仪器按有符号数返回
+    status = hipot.get_test_status(StatusDevice(f"{(1 << 15 | 1 << 9) - (1 << 16)}\n"))
+    assert hipot.TestStatus.IDLE in status
+    assert hipot.TestStatus.TEST not in status
+
+
+def test_test_status_flags(hipot):
+    status = hipot.get_test_status(StatusDevice("+33\n"))
+    assert status == hipot.TestStatus.TEST | hipot.TestStatus.PASS
+
+
+def test_test_status_rejects_garbage(hipot):
+    with pytest.raises(ValueError):
+        hipot.get_test_status(StatusDevice("ERR\n"))
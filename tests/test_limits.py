@@ -0,0 +1,49 @@
+# test_limits.py
+import numpy as np
+import pytest
+import limits
+
+
+def test_evaluate_limits_are_strict():
+    result = limits.evaluate([1.0, 5.0, 10.0], [1.0, 1.0, 1.0], [10.0, 10.0, 10.0], [1e3, 2e3, 3e3])
+    # 等于上下限都不合格
+    assert result.points['passed'].tolist() == [False, True, False]
+    assert not result.passed
+
+
+def test_evaluate_all_inside_passes():
+    result = limits.evaluate([2.0, 3.0], [1.0, 1.0], [10.0, 10.0], [1e3, 2e3])
+    assert result.passed
+    assert result.points['margin'].tolist() == [1.0, 2.0]
+
+
+def test_evaluate_worst_point():
+    # 余量: 4, 0.5(离上限近), 2
+    result = limits.evaluate([5.0, 9.5, 3.0], [1.0, 1.0, 1.0], [10.0, 10.0, 10.0], [1e3, 2e3, 3e3])
+    assert result.worst_index == 1
+    assert result.worst_freq == 2e3
+    assert result.worst_margin == pytest.approx(0.5)
+
+
+def test_evaluate_empty():
+    result = limits.evaluate([], [], [], [])
+    assert result.passed
+    assert result.worst_index == -1
+
+
+def test_limit_line_interpolates_on_log_frequency():
+    line = limits.LimitLine([1e3, 1e5], [0.0, 10.0])
+    # 1e4 在对数坐标上正好在中间
+    assert line.at([1e4]).tolist() == pytest.approx([5.0])
+
+
+def test_limit_line_clamps_outside_breakpoints():
+    line = limits.LimitLine([1e5, 1e3], [10.0, 0.0])
+    assert line.at([10.0, 1e3, 1e5, 1e7]).tolist() == pytest.approx([0.0, 0.0, 10.0, 10.0])
+
+
+def test_limit_line_caches_read_only_result():
+    line = limits.LimitLine([1e3, 1e5], [0.0, 10.0])
+    first = line.at(np.array([1e3, 1e4]))
+    assert line.at(np.array([1e3, 1e4])) is first
+    assert not first.flags.writeable
@@ -0,0 +1,92 @@
+# test_plc.py
+import threading
+import pytest
+import plc
+
+
+class Response:
+    def __init__(self, status_code, reply=None):
+        self.status_code = status_code
+        self.reply = reply
+
+    def json(self):
+        if self.reply is None:
+            raise ValueError
+        return self.reply
+
+
+class FakeSession:
+    def __init__(self, batch_status=200, batch_reply=None):
+        self.batch_status = batch_status
+        self.batch_reply = batch_reply
+        self.posts = []
+
+    def post(self, url, timeout=None, data=None, json=None):
+        self.posts.append((url, data if json is None else json))
+        if url == plc.plc_batch_url:
+            return Response(self.batch_status, self.batch_reply)
+        return Response(200)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def make(**kwargs):
+        fake = FakeSession(**kwargs)
+        monkeypatch.setattr(plc, "_session", fake)
+        return fake
+    monkeypatch.setattr(plc, "_batch_supported", True)
+    return make
+
+
+def test_write_plc_many_one_request(session):
+    fake = session(batch_reply={"D1": True, "D2": False})
+    assert plc.write_plc_many({"D1": 1, "D2": 2}) == {"D1": True, "D2": False}
+    assert fake.posts == [(plc.plc_batch_url, [{"address": "D1", "value": 1}, {"address": "D2", "value": 2}])]
+
+
+def test_write_plc_many_without_reply_body(session):
+    session()
+    assert plc.write_plc_many({"D1": 1, "D2": 2}) == {"D1": True, "D2": True}
+
+
+def test_write_plc_many_falls_back_when_batch_missing(session):
+    fake = session(batch_status=404)
+    assert plc.write_plc_many({"D1": 1, "D2": 2}) == {"D1": True, "D2": True}
+    # 以后不再尝试批量接口
+    assert plc.write_plc_many({"D3": 3}) == {"D3": True}
+    assert [url for url, _ in fake.posts] == [plc.plc_batch_url] + [plc.plc_url] * 3
+    assert not plc._batch_supported
+
+
+class BlockingSession(FakeSession):
+    # 第一次写入阻塞，模拟后台线程正在写入时又有新的写入
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def post(self, url, **kwargs):
+        if not self.started.is_set():
+            self.started.set()
+            assert self.release.wait(5)
+        return super().post(url, **kwargs)
+
+
+def test_async_writes_coalesce_and_flush(session, monkeypatch):
+    fake = BlockingSession()
+    monkeypatch.setattr(plc, "_session", fake)
+    plc.write_plc_async("D1", 1)
+    assert fake.started.wait(5)
+    # 写入进行中，同一地址只保留最后一次的值
+    for value in (2, 3, 4):
+        plc.write_plc_async("D1", value)
+    plc.write_plc_async("D2", 5)
+    assert not plc.flush_plc(timeout=0.05)
+    fake.release.set()
+    assert plc.flush_plc()
+    assert fake.posts == [(plc.plc_url, {"address": "D1", "value": 1}),
+                          (plc.plc_batch_url, [{"address": "D1", "value": 4}, {"address": "D2", "value": 5}])]
+
+
+def test_flush_plc_without_pending_writes():
+    assert plc.flush_plc(timeout=0)
@@ -0,0 +1,55 @@
+# test_registry.py
+import pytest
+import registry
+
+SCRIPT = '''
+from json import dumps
+demo_resouce = "GPIB0::1::INSTR"
+
+
+def main():
+    return dumps({"ok": True})
+
+
+def _helper():
+    pass
+
+
+def measure_iter():
+    yield 1
+
+
+async def wait_async():
+    pass
+'''
+
+
+@pytest.fixture
+def loaded(tmp_path, monkeypatch):
+    folder = tmp_path / "7"
+    folder.mkdir()
+    (folder / "DEMO-X1.py").write_text(SCRIPT, encoding="utf-8")
+    (folder / "BROKEN-X2.py").write_text("raise RuntimeError('no instrument')\n", encoding="utf-8")
+    monkeypatch.setattr(registry, "instrument_dir", str(tmp_path))
+    registry.load()
+    yield registry
+    for name in ("instrument.7.DEMO-X1", "instrument.7.BROKEN-X2"):
+        registry.sys.modules.pop(name, None)
+
+
+@pytest.mark.parametrize("alias", ["instrument/7/DEMO-X1.py", "instrument\\7\\DEMO-X1", "instrument.7.DEMO-X1"])
+def test_aliases_share_one_module(loaded, alias):
+    assert loaded.dispatch[(alias, "main")]() == '{"ok": true}'
+    assert loaded.resources[alias] == "GPIB0::1::INSTR"
+    assert loaded.modules[alias] is loaded.modules["instrument/7/DEMO-X1.py"]
+
+
+def test_only_own_plain_public_functions_are_exposed(loaded):
+    exposed = {name for alias, name in loaded.dispatch if alias == "instrument/7/DEMO-X1.py"}
+    # import 进来的函数、私有函数、生成器和协程函数都不开放
+    assert exposed == {"main"}
+
+
+def test_failed_module_is_recorded(loaded):
+    assert "no instrument" in loaded.failed["instrument/7/BROKEN-X2.py"]
+    assert "instrument/7/BROKEN-X2.py" not in loaded.modules
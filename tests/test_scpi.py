@@ -0,0 +1,65 @@
+# test_scpi.py
+import pytest
+import scpi
+
+
+class FakeDevice:
+    def __init__(self):
+        self.written = []
+
+    def write(self, message):
+        self.written.append(message)
+
+
+def test_batch_adds_root_colon():
+    device = FakeDevice()
+    with scpi.CommandBatch(device) as batch:
+        batch.write('FREQ 1000;')
+        batch.write(':VOLT 1')
+        batch.write('*CLS')
+        batch.write(' ; ')
+    assert device.written == [':FREQ 1000;:VOLT 1;*CLS']
+    assert batch.commands == 3
+    assert batch.saved == 2
+
+
+def test_batch_splits_at_max_length():
+    device = FakeDevice()
+    # 每条 5 个字符，两条加分号 11 个字符
+    batch = scpi.CommandBatch(device, max_length=11)
+    for command in (':AAAA', ':BBBB', ':CCCC'):
+        batch.write(command)
+    batch.flush()
+    assert device.written == [':AAAA;:BBBB', ':CCCC']
+    assert all(len(message) <= 11 for message in device.written)
+
+
+def test_batch_discards_on_error():
+    device = FakeDevice()
+    with pytest.raises(RuntimeError):
+        with scpi.CommandBatch(device) as batch:
+            batch.write(':FREQ 1000')
+            raise RuntimeError
+    assert device.written == []
+
+
+def test_poll_returns_none_on_timeout():
+    assert scpi.poll(lambda: 0, 0.02, interval=0.005) is None
+
+
+def test_poll_backs_off_to_max_interval(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(scpi.time, "sleep", sleeps.append)
+    results = iter([0, 0, 0, 0, 0, 'done'])
+    assert scpi.poll(lambda: next(results), 10, interval=0.001, max_interval=0.01, backoff=2) == 'done'
+    assert sleeps == pytest.approx([0.001, 0.002, 0.004, 0.008, 0.01])
+
+
+def test_wait_opc_checks_opc_bit():
+    class Device:
+        responses = iter(['+0', '+32', '+33'])
+
+        def query(self, command):
+            return next(self.responses)
+
+    assert scpi.wait_opc(Device(), 1, interval=0.001)
@@ -0,0 +1,68 @@
+# test_settling.py
+import pytest
+import settling
+
+
+@pytest.fixture
+def profile(tmp_path, monkeypatch):
+    # 每个测试使用自己的分布文件
+    monkeypatch.setattr(settling, "profile_file", str(tmp_path / "settle_profile.json"))
+    monkeypatch.setattr(settling, "_profile", None)
+    monkeypatch.setattr(settling, "_unsaved", 0)
+    monkeypatch.setattr(settling, "mode", "detect")
+
+
+def test_wait_stable_detects_stable_window(profile):
+    readings = iter([5.0, 3.0, 1.0, 1.0, 1.0])
+    settled = settling.wait_stable(lambda: next(readings), 0.01, 1, count=2)
+    assert settled.stable
+    assert settled.value == 1.0
+    assert settled.readings == 4
+
+
+def test_wait_stable_gives_up_after_max_wait(profile):
+    readings = iter([1.0, 2.0] * 1000)
+    settled = settling.wait_stable(lambda: next(readings), 0.01, 0.02, interval=0.005)
+    assert not settled.stable
+
+
+def test_wait_stable_accepts_new_value_before_stale_wait(profile):
+    settled = settling.wait_stable(lambda: 2.0, 0.01, 1, previous=1.0, stale_wait=0.5)
+    assert settled.stable
+    assert settled.elapsed < 0.5
+
+
+def test_wait_stable_holds_previous_value_until_stale_wait(profile):
+    # 读数和上一项一样时分不清夹具有没有动作，等到 stale_wait 才算稳定
+    settled = settling.wait_stable(lambda: 1.0, 0.01, 1, interval=0.005, previous=1.0, stale_wait=0.05)
+    assert settled.stable
+    assert settled.elapsed >= 0.05
+
+
+def test_percentile_edges():
+    samples = [4, 1, 3, 2]
+    assert settling._percentile([0.3], 95) == 0.3
+    assert settling._percentile(samples, 0) == 1
+    assert settling._percentile(samples, 50) == 2
+    assert settling._percentile(samples, 100) == 4
+    assert settling._percentile(list(range(1, 21)), 95) == 19
+
+
+def test_profile_mode_ignores_min_wait(profile):
+    settling.mode = "profile"
+    settled = settling.wait_stable(lambda: 1.0, 0.01, 1, min_wait=0.5, key="route")
+    # 记录的是读数实际稳定的时间，不受 min_wait 限制
+    assert settled.settled_after < 0.5
+    assert settling.get_profile()["route"]["count"] == 1
+
+
+def test_adaptive_delay_uses_recorded_percentile(profile, monkeypatch):
+    monkeypatch.setattr(settling, "min_samples", 2)
+    settling.mode = "profile"
+    for _ in range(2):
+        settling.wait_stable(lambda: 1.0, 0.01, 1, min_wait=0.5, key="route")
+    assert settling.delay("route", 5) == 0
+    settling.mode = "adaptive"
+    assert settling.delay("route", 0.5) < 0.5
+    # 没有记录的通路仍使用固定延时
+    assert settling.delay("other", 5) == 5
@@ -0,0 +1,99 @@
+# test_switch.py
+import json
+import pyvisa as visa
+import pytest
+import switch
+
+A = frozenset({"R1", "R2", "R3"})
+B = frozenset({"R3", "R4"})
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    monkeypatch.setattr(switch, "routes", {"A": A, "B": B})
+    monkeypatch.setattr(switch, "_commands", {(current, name): switch.route_command(switch.routes.get(current), target)
+                                              for name, target in switch.routes.items()
+                                              for current in (None, "A", "B")})
+    return switch.routes
+
+
+def test_route_command_only_changes_differing_relays(routes):
+    assert switch.route_command(A, B) == "ROUTE:OPEN (@R1,R2);:ROUTE:CLOSE (@R4)"
+
+
+def test_route_command_nothing_to_do(routes):
+    assert switch.route_command(A, A) == ""
+
+
+def test_route_command_unknown_state(routes):
+    # 不知道开关状态时断开其他通路的继电器，闭合目标通路的全部继电器
+    assert switch.route_command(None, B) == "ROUTE:OPEN (@R1,R2);:ROUTE:CLOSE (@R3,R4)"
+
+
+class FakeSwitch:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.written = []
+
+    def write(self, command):
+        if self.fail:
+            raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+        self.written.append(command)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    calls = []
+    state = {}
+    monkeypatch.setattr(switch.visa_pool, "session_state", lambda device: state)
+    monkeypatch.setattr(switch.visa_pool, "release_device", lambda device: calls.append("release"))
+    monkeypatch.setattr(switch.visa_pool, "invalidate", lambda resource: calls.append("invalidate"))
+    return calls
+
+
+def test_switch_channel_remembers_route(routes, pool, monkeypatch):
+    device = FakeSwitch()
+    monkeypatch.setattr(switch.visa_pool, "get_device", lambda resource: device)
+    assert switch.switch_channel("A")
+    # 已经在目标通路上，不再发送命令
+    assert not switch.switch_channel("A")
+    assert switch.switch_channel("B")
+    assert device.written == ["ROUTE:OPEN (@R4);:ROUTE:CLOSE (@R1,R2,R3)", "ROUTE:OPEN (@R1,R2);:ROUTE:CLOSE (@R4)"]
+    assert pool == ["release"] * 3
+
+
+def test_switch_channel_raises_and_invalidates(routes, pool, monkeypatch):
+    monkeypatch.setattr(switch.visa_pool, "get_device", lambda resource: FakeSwitch(fail=True))
+    with pytest.raises(visa.VisaIOError):
+        switch.switch_channel("A")
+    assert pool == ["invalidate"]
+
+
+@pytest.fixture
+def routes_file(tmp_path):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({
+        "A": {"relays": ["R1", "R2", "R3"], "settle_time": 0.2},
+        "B": {"relays": ["R3", "R4"]},
+    }), encoding="utf-8")
+    switch.load_routes(str(path))
+    yield path
+    switch.load_routes()
+
+
+def test_load_routes_precompiles_commands(routes_file):
+    assert switch.routes == {"A": A, "B": B}
+    assert switch._commands[("A", "B")] == "ROUTE:OPEN (@R1,R2);:ROUTE:CLOSE (@R4)"
+    assert switch._commands[("B", "B")] == ""
+    assert switch._commands[(None, "A")] == "ROUTE:OPEN (@R4);:ROUTE:CLOSE (@R1,R2,R3)"
+
+
+def test_load_routes_settle_times(routes_file):
+    assert switch.settle_time("A") == 0.2
+    assert switch.settle_time("B") == switch.default_settle_time
+    assert switch.settle_time("C") == switch.default_settle_time
+
+
+def test_switch_channel_unknown_route_raises(routes_file):
+    with pytest.raises(ValueError):
+        switch.switch_channel("C")
@@ -0,0 +1,86 @@
+# timing.py
+import contextvars
+from contextlib import nullcontext
+import functools
+import os
+import time
+
+# 环境变量 TIMING=0 时关闭，span 只剩一次上下文变量查询
+enabled = os.environ.get("TIMING", "1") != "0"
+
+# 当前测试流程收集的 [(步骤, 用时), ...]，没有在记录时为 None
+_spans = contextvars.ContextVar("timing_spans", default=None)
+_noop = nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "spans", "start")
+
+    def __init__(self, name, spans):
+        self.name = name
+        self.spans = spans
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.spans.append((self.name, time.perf_counter() - self.start))
+        return False
+
+
+def span(name):
+    """
+    with timing.span("fetch"): ... 记录这段代码的用时，不在 traced 的流程里时什么也不做
+    :param name: 步骤名，同名步骤的用时累加
+    """
+    spans = _spans.get()
+    if spans is None:
+        return _noop
+    return _Span(name, spans)
+
+
+def sleep(seconds):
+    # 计时的 time.sleep
+    with span("sleep"):
+        time.sleep(seconds)
+
+
+def summary(spans, total):
+    """
+    汇总各步骤用时，嵌套的步骤会同时计入外层步骤
+    :param spans: [(步骤, 用时), ...]
+    :param total: 整个流程的用时(秒)
+    :return: {"total": 秒, 步骤: {"count": 次数, "time": 秒}, ...}
+    """
+    result = {"total": round(total, 4)}
+    for name, elapsed in spans:
+        step = result.setdefault(name, {"count": 0, "time": 0.0})
+        step["count"] += 1
+        step["time"] += elapsed
+    for name, step in result.items():
+        if name != "total":
+            step["time"] = round(step["time"], 4)
+    return result
+
+
+def traced(func):
+    """
+    装饰测试流程的 main()，执行期间的各步骤用时汇总后放到返回结果的 Timing 里
+    在其他线程里执行的步骤需要用 contextvars.copy_context().run 提交才会被记录
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        spans = []
+        token = _spans.set(spans)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _spans.reset(token)
+        if isinstance(result, dict):
+            result["Timing"] = summary(spans, time.perf_counter() - start)
+        return result
+    return wrapper
@@ -0,0 +1,147 @@
+# visa_pool.py
+import atexit
+import threading
+import time
+import pyvisa as visa
+import timing
+from logger import logger as logging
+
+# 会话空闲超过该时间(秒)后，下次取用前做一次轻量健康检查
+check_interval = 30
+# 健康检查查询的超时时间(毫秒)
+check_timeout = 2000
+
+_lock = threading.Lock()
+_rm = None
+# resource -> 会话信息
+_sessions = {}
+# resource -> 锁，不同仪器的连接互不阻塞
+_locks = {}
+
+
+def _resource_manager():
+    # 整个进程只创建一个资源管理器
+    global _rm
+    with _lock:
+        if _rm is None:
+            _rm = visa.ResourceManager()
+        return _rm
+
+
+def _resource_lock(resource):
+    with _lock:
+        return _locks.setdefault(resource, threading.Lock())
+
+
+def _open(resource):
+    device = _resource_manager().open_resource(resource)
+    # 只在真正建立连接时查询一次 *IDN?
+    if device.query('*IDN?') == '':
+        logging.debug(f"{resource} 连接失败")
+    else:
+        logging.debug(f"{resource} 连接成功")
+    return device
+
+
+def _healthy(device):
+    # *OPC? 是所有仪器都支持的最轻量查询
+    timeout = device.timeout
+    try:
+        device.timeout = check_timeout
+        # 清掉上次中断时残留在缓冲区的数据
+        try:
+            device.clear()
+        except NotImplementedError:
+            pass
+        return device.query('*OPC?').strip() != ''
+    except (visa.VisaIOError, visa.errors.InvalidSession):
+        return False
+    finally:
+        try:
+            device.timeout = timeout
+        except visa.errors.InvalidSession:
+            pass
+
+
+def _close(device):
+    try:
+        device.close()
+    except (visa.VisaIOError, visa.errors.InvalidSession):
+        pass
+
+
+def get_device(resource):
+    """
+    从会话池取出设备，不存在或失效时重新连接
+    :param resource: 设备资源地址
+    :return: 设备对象
+    """
+    with timing.span("connect"), _resource_lock(resource):
+        entry = _sessions.get(resource)
+        if entry is not None:
+            # 上次没有正常归还(中途出错)或空闲太久，先检查连接是否可用
+            idle = time.monotonic() - entry['last_used']
+            if entry['in_use'] or idle > check_interval:
+                if not _healthy(entry['device']):
+                    logging.info(f"{resource} 会话失效，重新连接")
+                    _close(entry['device'])
+                    entry = None
+        if entry is None:
+            # state 保存仪器当前设置，重新连接后清空
+            entry = {'device': _open(resource), 'state': {}}
+            with _lock:
+                _sessions[resource] = entry
+        entry['in_use'] = True
+        entry['last_used'] = time.monotonic()
+        return entry['device']
+
+
+def release_device(device):
+    """
+    归还设备，会话保持打开供下次使用
+    :param device: 设备对象
+    """
+    # 资源名会被 pyvisa 规范化，按对象查找对应的会话
+    with _lock:
+        entry = next((e for e in _sessions.values() if e['device'] is device), None)
+    if entry is not None:
+        entry['in_use'] = False
+        entry['last_used'] = time.monotonic()
+
+
+def session_state(device):
+    """
+    取得会话对应的状态字典，驱动用来缓存已经下发的设置
+    会话重新连接后是一个新的空字典
+    :param device: 设备对象
+    :return: 状态字典
+    """
+    with _lock:
+        entry = next((e for e in _sessions.values() if e['device'] is device), None)
+    if entry is None:
+        # 不在会话池里的设备不做缓存
+        return {}
+    return entry['state']
+
+
+def invalidate(resource):
+    """
+    关闭并丢弃会话，下次取用时重新连接
+    :param resource: 设备资源地址
+    """
+    with _resource_lock(resource), _lock:
+        entry = _sessions.pop(resource, None)
+    if entry is not None:
+        _close(entry['device'])
+
+
+def close_all():
+    # 进程退出时关闭所有会话
+    with _lock:
+        entries = list(_sessions.values())
+        _sessions.clear()
+    for entry in entries:
+        _close(entry['device'])
+
+
+atexit.register(close_all)